@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""End-to-end benchmark of wsc_clean on synthetic cohorts of increasing size.
+
+For each cohort size a corpus is written with make_corpus.py in a temporary folder, then:
+* find_recordings is timed on the folder
+* iter_twin_events and iter_gamma_events are timed on all the recordings of their format (no output is written)
+* main() is run end to end in a separate process, its peak RSS is read from the resources of the child process
+Throughput is reported as output lines per second (recordings per second for find_recordings).
+Warnings of the parsers are ignored.
+
+Usage: python benchmarks/bench_cohort.py [--sizes N [N ...]] [--epochs N] [--jobs N] [--seed N]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import warnings
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from make_corpus import write_corpus
+from wisconsinsc_cleaner import wsc_clean
+
+REPO_FOLDER = str(Path(__file__).resolve().parents[1])
+
+
+def time_find_recordings(folder, number=5):
+    """Return the best time of find_recordings over number runs and the number of recordings"""
+    best = float('inf')
+    for _ in range(number):
+        t_start = perf_counter()
+        recordings = wsc_clean.find_recordings(folder)
+        best = min(best, perf_counter()-t_start)
+    return best, len(recordings)
+
+
+def time_parsers(folder, recordings, mapping):
+    """Return time and output lines of the twin and gamma parsers on all recordings"""
+    results = {'twin': [0.0, 0], 'gamma': [0.0, 0]}
+    for recording in recordings:
+        recording_path = f"{folder}/{recording}"
+        if Path(f"{recording_path}.allscore.txt").exists():
+            parser, events = 'twin', wsc_clean.iter_twin_events(f"{recording_path}.allscore.txt", mapping)
+        else:
+            parser, events = 'gamma', wsc_clean.iter_gamma_events(recording_path, mapping)
+        t_start = perf_counter()
+        try:
+            n_lines = sum(1 for _ in events)
+        except wsc_clean.OutOfOrderError:
+            # Lines displaced beyond the reorder buffer, sorted as a whole as in process_gamma_log
+            n_lines = sum(1 for _ in wsc_clean.iter_gamma_events(recording_path, mapping, reorder_buffer=None))
+        results[parser][0] += perf_counter()-t_start
+        results[parser][1] += n_lines
+    return results
+
+
+def run_main(folder, jobs, work_folder):
+    """Run wsc_clean main() on folder in a new process. Return elapsed time and peak RSS in MiB"""
+    command = [sys.executable, '-W', 'ignore', '-c', 'from wisconsinsc_cleaner.wsc_clean import main; main()', folder, '--force', '--jobs', str(jobs)]
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join([REPO_FOLDER, os.environ.get('PYTHONPATH', '')]))
+    t_start = perf_counter()
+    process = subprocess.Popen(command, cwd=work_folder, env=environment, stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = perf_counter()-t_start
+    if status != 0:
+        raise RuntimeError(f"wsc_clean failed on {folder} with status {status}")
+    # ru_maxrss is in KiB on Linux and in bytes on macOS. With --jobs, it is the peak of the main process only
+    peak_rss = usage.ru_maxrss/(1024*1024 if sys.platform == 'darwin' else 1024)
+    return elapsed, peak_rss
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs='+', default=[10, 100], help="Number of recordings of the cohorts. Defaults to 10 100")
+    parser.add_argument("--epochs", type=int, default=960, help="Average number of epochs of a recording. Defaults to 960 (8 hours)")
+    parser.add_argument("--gamma-fraction", type=float, default=0.5, help="Fraction of gamma recordings. Defaults to 0.5")
+    parser.add_argument("--jobs", type=int, default=1, help="--jobs option of wsc_clean for the end-to-end run. Defaults to 1")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the corpus. Defaults to 0")
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore')
+    mapping = wsc_clean.load_mappings()
+    print(f"{'recordings':>10} {'stage':<16}{'time [s]':>10}{'lines':>10}{'lines/s':>12}{'peak RSS [MiB]':>16}")
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as work_folder:
+            folder = f"{work_folder}/polysomnography/"
+            recordings, n_input_lines = write_corpus(folder, size, args.gamma_fraction, args.epochs, args.seed)
+
+            t_find, n_found = time_find_recordings(folder)
+            assert n_found == len(recordings), f"find_recordings found {n_found} of {len(recordings)} recordings"
+            print(f"{size:>10} {'find_recordings':<16}{t_find:>10.3f}{n_found:>10}{n_found/t_find:>12.0f}")
+
+            n_output_lines = 0
+            for name, (elapsed, n_lines) in time_parsers(folder[:-1], recordings, mapping).items():
+                n_output_lines += n_lines
+                if n_lines > 0:
+                    print(f"{size:>10} {name:<16}{elapsed:>10.3f}{n_lines:>10}{n_lines/elapsed:>12.0f}")
+
+            elapsed, peak_rss = run_main(folder, args.jobs, work_folder)
+            print(f"{size:>10} {'main':<16}{elapsed:>10.3f}{n_output_lines:>10}{n_output_lines/elapsed:>12.0f}{peak_rss:>16.1f}")
+            print(f"{size:>10} {'input lines':<16}{'':>10}{n_input_lines:>10}")
+
+
+if __name__ == "__main__":
+    main()
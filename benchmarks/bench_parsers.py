@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmark of the per-line cost of the twin and gamma parsers.
+
+The 'before' functions are the original implementations that build the pattern strings
+and go through the re module cache on every call. The 'after' functions are the ones in wsc_clean, with wsc_clean.Mapper.
+parse_event_gamma of wsc_clean also formats the timestamp of the output line.
+
+Usage: python benchmarks/bench_parsers.py [--number N]
+"""
+import argparse
+import re
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+from timeit import timeit
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from wisconsinsc_cleaner import wsc_clean
+
+MAPPING = {
+    'respiratory event obstructive apnea': 'apnea:obstructive',
+    'desaturation': 'desaturation',
+    'arousal spontaneous': 'arousal:spontaneous',
+    'gamma_obs apnea': 'apnea:obstructive',
+    'gamma_desaturation': 'desaturation',
+    'gamma_arousal': 'arousal',
+}
+
+TWIN_LINES = [
+    "respiratory event - dur: 12.5 sec. - obstructive apnea - desat 85.0 %",
+    "desaturation - dur: 20.0 sec. - min 88.0 % - drop 4.0 %",
+    "arousal - dur: 3.0 sec. - spontaneous",
+    "lm - dur: 1.5 sec. - plm",
+    "arousal - plm",
+]
+GAMMA_EVENT_LINES = [
+    "125\t37500\t2\tObs Apnea\t1\t23:35:10\t85.0\t\t15.2",
+    "130\t39000\t2\tDesaturation\t1\t23:37:40\t88\t4\t0.12",
+    "131\t39300\t2\tArousal\t1\t23:38:15",
+]
+GAMMA_GAIN_LINES = ["saO2 (3) : gain : 20", "chin emg (12) : gain: 100"]
+GAMMA_TIMESTAMPS = ["23:35:10", "23:35:10 125", " 125"]
+map_event = lambda x,m: m.get(x, f"misc:{x}")
+# The parsers of wsc_clean return the fields of the output line, converted to the dicts of the original implementations
+TWIN_FIELDS = ['EventKey', 'Duration', 'Param1', 'Param2', 'Param3']
+GAIN_FIELDS = ['EventKey', 'Param1', 'Param2']
+EMPTY_LINE = dict(zip(wsc_clean.OUTPUT_HEADER, ['00:00:00.00', 'error', -1, 0, 0, 0]))
+
+
+def parse_event_twin_before(event_string, mapping):
+    output = {}
+    if event_string.startswith('respiratory event'):
+        regex = r"(?P<event_key>[\w]+\s[\w]+) - dur: (?P<Duration>[\d]+.[\d]) sec. - (?P<event_type>[\w]+\s?[\w]*) - desat (?P<Param1>[-]?[\d]+.[\d]|<n/a>)\s?[%]?"
+    elif event_string.startswith('desat'):
+        regex = r"(?P<event_key>[\w]+) - dur: (?P<Duration>[\d]+.[\d]) sec. - min (?P<Param1>[\d]+.[\d]) % - drop (?P<Param2>[-]?[\d]+.[\d]) %"
+    elif any(event_string.startswith(x) for x in ['arousal', 'lm', 'ekg', 'snore']):
+        regex = r"(?P<event_key>([\w]+|[\w]+\s[\w]+))( - dur: (?P<Duration>[\d]+.[\d]) sec. |\s)- (?P<event_type>[\w]+\s?[\w]*)"
+    else:
+        return None
+    match = re.match(regex, event_string)
+    if match:
+        match_dict = match.groupdict()
+        output['EventKey'] = map_event(f"{match_dict['event_key']} {match_dict.get('event_type','')}".strip(), mapping)
+        output['Duration'] = match_dict.get('Duration', 3.0)
+        for i in range(1, 4):
+            output[f'Param{i}'] = match_dict.get(f'Param{i}', 0)
+        return output
+    return None
+
+
+def parse_timestamp_gamma_before(timestamp_str, start_time=None, timestamp_correction=timedelta(seconds=0)):
+    timestamp_split = re.sub(r"\s+", " ", timestamp_str).split()
+    if len(timestamp_split)<=2 and re.match(r"\d{1,2}:\d{2}:\d{2}", timestamp_split[0]):
+        return datetime.strptime(timestamp_split[0], "%H:%M:%S")+timestamp_correction
+    elif len(timestamp_split)<=2 and start_time is not None:
+        if re.match(r"\d+", timestamp_split[0]):
+            return start_time+timedelta(seconds=(int(timestamp_split[0])-1)*30)
+        elif len(timestamp_split)==2 and re.match(r"\d+", timestamp_split[1]):
+            return start_time+timedelta(seconds=(int(timestamp_split[1])-1)*30)
+    return None
+
+
+def parse_gain_gamma_before(event_string):
+    event_string_sub = re.sub(r"\s+", " ", event_string).strip("\t ")
+    regex = r"(?P<event_key>([\w]+|[\w]+\s[\w]+)) \((?P<Param2>\d+)\) : gain\s?: (?P<Param1>\d+)"
+    match = re.match(regex, event_string_sub)
+    if match:
+        match_dict = match.groupdict()
+        return {'EventKey': f"gain:{match_dict['event_key']}", 'Param1': match_dict['Param1'], 'Param2': match_dict['Param2']}
+    return None
+
+
+def parse_event_gamma_before(event_string, start_time, timestamp_correction, mapping):
+    output_line = dict(EMPTY_LINE)
+    regex = r"(?P<Epoch>\d+) (?:(-?\d+\s?-?\d+|)) (?:-?\d+) (?P<event_key>([a-z]+2?|[a-z]+\.?\s[a-z]+2?\s?[a-z^\d]*)) (?:\d+) (?P<timestamp>(\d{1,2}:\d{2}:\d{2}|))\s?(?P<Param1>-*\d*.?\d*)\s?(?P<Param2>-?\d*.?\d*)\s?(?P<Duration>(-?\d*.?\d*))"
+    event_string_sub = re.sub(r"\s+", " ", event_string).strip("\t ").lower()
+    match = re.fullmatch(regex, event_string_sub)
+    if match:
+        match_dict = match.groupdict()
+        output_line['EventKey'] = map_event(f"gamma_{match_dict['event_key']}", mapping)
+        output_line['Timestamp'] = parse_timestamp_gamma_before(f"{match_dict['timestamp']} {match_dict['Epoch']}", start_time, timestamp_correction)
+        if match_dict['Param2']!='' and match_dict['Duration']=='':
+            match_dict['Duration'] = match_dict.pop('Param2')
+        if match_dict['Duration']=='' and any(output_line['EventKey'].startswith(x) for x in ['arousal', 'leg_movement', 'snore', 'artifact']):
+            output_line['Duration'] = 3
+        else:
+            match_dict['Duration'] = float(match_dict['Duration'])
+            if (match_dict['Duration'] < 10 and output_line['EventKey']=='desaturation') or (match_dict['Duration'] < 5):
+                output_line['Duration'] = match_dict['Duration']*100
+            else:
+                output_line['Duration'] = match_dict['Duration']
+        for i in range(1, 4):
+            output_line[f'Param{i}'] = match_dict.get(f'Param{i}', 0)
+        return output_line
+    return None
+
+
+def as_dict(fields, parsed_line):
+    """Return the fields returned by a parser of wsc_clean as a dict"""
+    return dict(zip(fields, parsed_line)) if parsed_line is not None else None
+
+
+def gamma_event_dict(parsed_line):
+    """Return the (datetime, Event) of wsc_clean.parse_event_gamma as a dict with the datetime as Timestamp"""
+    if parsed_line is None:
+        return None
+    timestamp, output_line = parsed_line
+    return output_line._replace(Timestamp=timestamp)._asdict()
+
+
+def per_line_us(function, lines, number):
+    """Return the average cost of a call in microseconds"""
+    elapsed = timeit(lambda: [function(line) for line in lines], number=number)
+    return elapsed/(number*len(lines))*1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=20000, help="Repetitions over the synthetic lines")
+    args = parser.parse_args()
+
+    mapper = wsc_clean.Mapper(MAPPING)
+    start_time = datetime.strptime("22:10:00", "%H:%M:%S")
+    correction = timedelta(hours=0)
+    cases = [
+        ("parse_event_twin", TWIN_LINES,
+            lambda x: parse_event_twin_before(x, MAPPING), lambda x: wsc_clean.parse_event_twin(x, mapper), lambda x: as_dict(TWIN_FIELDS, x)),
+        ("parse_event_gamma", GAMMA_EVENT_LINES,
+            lambda x: parse_event_gamma_before(x, start_time, correction, MAPPING), lambda x: wsc_clean.parse_event_gamma(x, start_time, correction, mapper), gamma_event_dict),
+        ("parse_gain_gamma", GAMMA_GAIN_LINES,
+            parse_gain_gamma_before, wsc_clean.parse_gain_gamma, lambda x: as_dict(GAIN_FIELDS, x)),
+        ("parse_timestamp_gamma", GAMMA_TIMESTAMPS,
+            lambda x: parse_timestamp_gamma_before(x, start_time), lambda x: wsc_clean.parse_timestamp_gamma(x, start_time), lambda x: x),
+    ]
+
+    print(f"{'parser':<24}{'before [us/line]':>18}{'after [us/line]':>18}{'speedup':>10}")
+    for name, lines, before, after, convert in cases:
+        # Both implementations must return the same results
+        assert [before(x) for x in lines] == [convert(after(x)) for x in lines], f"Mismatch in {name}"
+        t_before = per_line_us(before, lines, args.number)
+        t_after = per_line_us(after, lines, args.number)
+        print(f"{name:<24}{t_before:>18.2f}{t_after:>18.2f}{t_before/t_after:>9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
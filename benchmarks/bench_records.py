@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""Memory and time of the output lines of a recording: dicts vs Event named tuples.
+
+The 'before' lines are the original six-key dicts created with copy(EMPTY_LINE), updated from the parser
+output and written with csv.DictWriter. The 'after' lines are the wsc_clean.Event records written with csv.writer.
+Allocated blocks and peak memory are measured with tracemalloc while all the lines of a recording are kept in memory.
+
+Usage: python benchmarks/bench_records.py [--lines N] [--number N]
+"""
+import argparse
+import csv
+import io
+import sys
+import tracemalloc
+from copy import copy
+from pathlib import Path
+from timeit import timeit
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from wisconsinsc_cleaner import wsc_clean
+
+EMPTY_LINE = dict(zip(wsc_clean.OUTPUT_HEADER, ['00:00:00.00', 'error', -1, 0, 0, 0]))
+# Fields of the parsed events (see parse_event_twin), cycled over the lines of the synthetic recording
+PARSED_EVENTS = [
+    {'EventKey': 'apnea:obstructive', 'Duration': '12.5', 'Param1': '85.0', 'Param2': 0, 'Param3': 0},
+    {'EventKey': 'desaturation', 'Duration': '20.0', 'Param1': '88.0', 'Param2': '4.0', 'Param3': 0},
+    {'EventKey': 'arousal:spontaneous', 'Duration': '3.0', 'Param1': 0, 'Param2': 0, 'Param3': 0},
+]
+STAGES = ['stage:w', 'stage:n1', 'stage:n2', 'stage:n3', 'stage:rem']
+
+
+def timestamps(n_lines):
+    """Timestamps of the lines, one epoch of 30s every 4 lines"""
+    return [wsc_clean.format_seconds(22*3600+(i//4)*30) for i in range(n_lines)]
+
+
+def lines_before(stamps):
+    output = []
+    for i, timestamp in enumerate(stamps):
+        output_line = copy(EMPTY_LINE)
+        output_line['Timestamp'] = timestamp
+        if i % 4 == 0:
+            output_line['EventKey'] = STAGES[i % len(STAGES)]
+        else:
+            output_line.update(PARSED_EVENTS[i % len(PARSED_EVENTS)])
+        output.append(output_line)
+    return output
+
+
+def lines_after(stamps):
+    output = []
+    for i, timestamp in enumerate(stamps):
+        if i % 4 == 0:
+            output.append(wsc_clean.Event(timestamp, STAGES[i % len(STAGES)]))
+        else:
+            output.append(wsc_clean.Event(timestamp, **PARSED_EVENTS[i % len(PARSED_EVENTS)]))
+    return output
+
+
+def write_before(output_lines):
+    output_file = io.StringIO()
+    writer = csv.DictWriter(output_file, fieldnames=wsc_clean.OUTPUT_HEADER, lineterminator='\n')
+    writer.writeheader()
+    writer.writerows(output_lines)
+    return output_file.getvalue()
+
+
+def write_after(output_lines):
+    output_file = io.StringIO()
+    writer = csv.writer(output_file, lineterminator='\n')
+    writer.writerow(wsc_clean.OUTPUT_HEADER)
+    writer.writerows(output_lines)
+    return output_file.getvalue()
+
+
+def traced(function, *args):
+    """Return number of allocated blocks still alive and peak memory in bytes while building the lines"""
+    tracemalloc.start()
+    output = function(*args)
+    snapshot = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    blocks = sum(stat.count for stat in snapshot.statistics('filename'))
+    del output
+    return blocks, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=4000, help="Lines of the synthetic recording (a night of 8h has ~1000 epochs)")
+    parser.add_argument("--number", type=int, default=20, help="Repetitions of the timed runs")
+    args = parser.parse_args()
+
+    stamps = timestamps(args.lines)
+    # Both records must write the same file
+    assert write_before(lines_before(stamps)) == write_after(lines_after(stamps)), "Mismatch in the output"
+
+    print(f"{'records':<10}{'blocks':>10}{'peak [KiB]':>12}{'build [ms]':>12}{'write [ms]':>12}")
+    results = {}
+    for name, build, write in [("dict", lines_before, write_before), ("Event", lines_after, write_after)]:
+        blocks, peak = traced(build, stamps)
+        output_lines = build(stamps)
+        t_build = timeit(lambda: build(stamps), number=args.number)/args.number*1e3
+        t_write = timeit(lambda: write(output_lines), number=args.number)/args.number*1e3
+        results[name] = (blocks, peak)
+        print(f"{name:<10}{blocks:>10}{peak/1024:>12.1f}{t_build:>12.2f}{t_write:>12.2f}")
+
+    print(f"Blocks reduced by {results['dict'][0]/results['Event'][0]:.2f}x, peak memory by {results['dict'][1]/results['Event'][1]:.2f}x for {args.lines} lines")
+
+
+if __name__ == "__main__":
+    main()
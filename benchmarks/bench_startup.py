@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""Cold start regression check of wsc_clean: import time of the module and wall time of `wsc_clean --help`.
+
+The import time is read from `python -X importtime` (cumulative time of wisconsinsc_cleaner.wsc_clean, best of
+--number runs in new processes). The check fails (exit status 1) if it is above --budget-ms or if any of the modules
+that must be imported lazily (optional dependencies, multiprocessing, sqlite3...) is imported with the module.
+
+Usage: python benchmarks/bench_startup.py [--budget-ms N] [--number N]
+"""
+import argparse
+import os
+import subprocess
+import sys
+from pathlib import Path
+from time import perf_counter
+
+REPO_FOLDER = str(Path(__file__).resolve().parents[1])
+MODULE = 'wisconsinsc_cleaner.wsc_clean'
+# Modules imported only by the functions that need them
+LAZY_MODULES = ['numpy', 'pyarrow', 'zstandard', 'multiprocessing', 'concurrent.futures', 'sqlite3', 'argparse', 'cProfile',
+                'gzip', 'hashlib', 'importlib.resources', 'pathlib2']
+
+
+def run_python(arguments):
+    """Run python with arguments and the repository in PYTHONPATH. Return the completed process and its wall time"""
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join([REPO_FOLDER, os.environ.get('PYTHONPATH', '')]))
+    t_start = perf_counter()
+    process = subprocess.run([sys.executable]+arguments, env=environment, capture_output=True, text=True, check=True)
+    return process, perf_counter()-t_start
+
+
+def import_times():
+    """Return the cumulative import time in microseconds of each module imported by wsc_clean"""
+    process, _ = run_python(['-X', 'importtime', '-c', f'import {MODULE}'])
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget-ms", type=float, default=75, help="Maximum import time of wsc_clean in milliseconds. Defaults to 75")
+    parser.add_argument("--number", type=int, default=5, help="Number of runs, the best one is reported. Defaults to 5")
+    args = parser.parse_args()
+
+    # First run writes the bytecode cache
+    run_python(['-c', f'import {MODULE}'])
+    runs = [import_times() for _ in range(args.number)]
+    best = min(runs, key=lambda x:x[MODULE])
+    t_help = min(run_python(['-c', f'from {MODULE} import main; main()', '--help'])[1] for _ in range(args.number))
+    t_python = min(run_python(['-c', 'pass'])[1] for _ in range(args.number))
+
+    print(f"{'module':<40}{'cumulative [ms]':>16}")
+    for name, cumulative in sorted(best.items(), key=lambda x:-x[1])[:10]:
+        print(f"{name:<40}{cumulative/1e3:>16.1f}")
+    print(f"wsc_clean --help: {t_help*1e3:.1f} ms (python without imports: {t_python*1e3:.1f} ms)")
+
+    failed = False
+    eager = [name for name in LAZY_MODULES if name in best]
+    if len(eager) > 0:
+        print(f"FAIL: modules imported at startup: {', '.join(eager)}")
+        failed = True
+    if best[MODULE]/1e3 > args.budget_ms:
+        print(f"FAIL: import time {best[MODULE]/1e3:.1f} ms above the budget of {args.budget_ms} ms")
+        failed = True
+    if not failed:
+        print(f"OK: import time {best[MODULE]/1e3:.1f} ms within the budget of {args.budget_ms} ms")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
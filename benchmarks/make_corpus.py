@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""Generate a synthetic WSC cohort with Twin (.allscore.txt) and Gamma (.log/.sco/.stg.txt) recordings.
+
+The files follow the layout of the NSRR files and include the dirty cases listed in KNOWN_ISSUES.md:
+'--/--/--' prefixes and epoch-only timestamps in logs, am/pm clocks, negative and /100 durations,
+missing and repeated header lines, events without duration and negative SpO2 values.
+The content is random but reproducible with the same seed.
+
+Usage: python benchmarks/make_corpus.py <folder> [--recordings N] [--gamma-fraction F] [--epochs N] [--seed N]
+"""
+import argparse
+import random
+from pathlib import Path
+
+EPOCH_LENGTH = 30
+
+TWIN_STAGES = ['STAGE - W', 'STAGE - N1', 'STAGE - N2', 'STAGE - N3', 'STAGE - R', 'STAGE - NO STAGE']
+TWIN_POSITIONS = ['POSITION - SUPINE', 'POSITION - LEFT', 'POSITION - RIGHT', 'POSITION - PRONE']
+TWIN_MISC = ['LIGHTS OUT', 'LIGHTS ON', 'PT. TO BATHROOM', 'BACK IN BED', 'Tech in room', 'patient moved a lot']
+TWIN_RESPIRATORY = ['Obstructive Apnea', 'Central Apnea', 'Mixed Apnea', 'Hypopnea']
+TWIN_AROUSALS = ['Spontaneous', 'Respiratory Event', 'LM', 'PLM', 'Snore']
+
+GAMMA_STAGES = ['0', '1', '2', '3', '4', '5', '6', '7']
+GAMMA_LOG_EVENTS = ['Lights Out', 'Lights On', 'Back', 'Left', 'Right', 'Front', 'Gain Set Pushed On NP', 'bathroom break', 'tech in']
+GAMMA_GAINS = ['SaO2 (3) : Gain : 20', 'Chin EMG (12) : Gain: 100', 'Nasal Pres (7) : Gain : 50']
+GAMMA_EVENTS = ['Obs Apnea', 'Hypopnea', 'Central Apnea', 'SaO2', 'Arousal', 'Spon Arousal', 'LM', 'Snore']
+
+
+def clock(seconds, ampm=False):
+    """Format seconds from midnight as hh:mm:ss, on a 12h clock for am/pm recordings"""
+    minutes, seconds = divmod(int(seconds) % 86400, 60)
+    hours, minutes = divmod(minutes, 60)
+    if ampm:
+        hours = hours % 12 or 12
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+
+def stage_sequence(rng, n_epochs, stages):
+    """Sleep stages that stay the same for a few epochs, like a hypnogram"""
+    output = []
+    while len(output) < n_epochs:
+        output += [rng.choice(stages)]*rng.randint(1, 20)
+    return output[:n_epochs]
+
+
+def twin_event(rng):
+    """Event string of a twin file with the dirty cases of the real files"""
+    kind = rng.random()
+    if kind < 0.35:
+        # Negative SpO2 or not available
+        desat = rng.choice([f"{rng.uniform(75, 95):.1f} %", f"-{rng.uniform(1, 6):.1f} %", "<N/A>"])
+        return f"Respiratory Event - Dur: {rng.uniform(10, 60):.1f} sec. - {rng.choice(TWIN_RESPIRATORY)} - Desat {desat}"
+    if kind < 0.6:
+        return f"Desaturation - Dur: {rng.uniform(5, 60):.1f} sec. - Min {rng.uniform(75, 95):.1f} % - Drop {rng.uniform(1, 10):.1f} %"
+    if kind < 0.8:
+        # Some arousals do not have a duration
+        if rng.random() < 0.2:
+            return f"Arousal - {rng.choice(TWIN_AROUSALS)}"
+        return f"Arousal - Dur: {rng.uniform(3, 15):.1f} sec. - {rng.choice(TWIN_AROUSALS)}"
+    if kind < 0.9:
+        return f"LM - Dur: {rng.uniform(0.5, 10):.1f} sec. - {rng.choice(['Isolated', 'Periodic'])}"
+    if kind < 0.95:
+        return f"EKG Events - Dur: {rng.uniform(0.1, 30):.1f} sec. - Sinus Tachycardia"
+    return f"Snore - Dur: {rng.uniform(1, 10):.1f} sec. - Periodic"
+
+
+def write_twin(path, rng, n_epochs, start_seconds):
+    """Write a twin .allscore.txt file. Return the number of lines"""
+    lines = [f"{clock(start_seconds)}.00\tSTART RECORDING", f"{clock(start_seconds)}.00\tLIGHTS OUT"]
+    for epoch, stage in enumerate(stage_sequence(rng, n_epochs, TWIN_STAGES)):
+        seconds = start_seconds + epoch*EPOCH_LENGTH
+        lines.append(f"{clock(seconds)}.00\t{stage}")
+        for _ in range(rng.choice([0, 0, 0, 1, 1, 2])):
+            lines.append(f"{clock(seconds+rng.randint(1, EPOCH_LENGTH-1))}.{rng.randint(0, 99):02d}\t{twin_event(rng)}")
+        if rng.random() < 0.02:
+            lines.append(f"{clock(seconds)}.00\t{rng.choice(TWIN_POSITIONS+TWIN_MISC)}")
+    lines.append(f"{clock(start_seconds+n_epochs*EPOCH_LENGTH)}.00\tSTOP RECORDING")
+    with open(path, 'w', encoding='utf-8') as output_file:
+        output_file.write('\n'.join(lines)+'\n')
+    return len(lines)
+
+
+def write_gamma(path, rng, n_epochs, start_seconds, ampm):
+    """Write the .log, .sco and .stg files of a gamma recording. Return the number of lines"""
+    # Log. The first line always has a valid timestamp
+    log_lines = [f"{clock(start_seconds, ampm)}\tLights Out\t1"]
+    for _ in range(max(n_epochs//10, 1)):
+        epoch = rng.randint(1, n_epochs)
+        seconds = start_seconds + (epoch-1)*EPOCH_LENGTH + rng.randint(0, EPOCH_LENGTH-1)
+        event = rng.choice(GAMMA_LOG_EVENTS+GAMMA_GAINS)
+        kind = rng.random()
+        if kind < 0.05:
+            log_lines.append(f"--/--/--\t{clock(seconds, ampm)}\t{event}\t{epoch}")
+        elif kind < 0.1:
+            log_lines.append(f"{epoch}\t{event}\t{epoch}")
+        else:
+            log_lines.append(f"{clock(seconds, ampm)}\t{event}\t{epoch}")
+    # Lines are almost sorted in time
+    log_lines[1:] = sorted(log_lines[1:], key=lambda x:int(x.split('\t')[-1]))
+
+    # Stages. Header line is in most files, but not all of them
+    stage_lines = ["Epoch\tUser-Defined Stage\tCAST-Defined Stage"] if rng.random() < 0.9 else []
+    for epoch, stage in enumerate(stage_sequence(rng, n_epochs, GAMMA_STAGES), start=1):
+        stage_lines.append(f"{epoch}\t{stage}\t{rng.choice(GAMMA_STAGES)}")
+
+    # Scoring. Sometimes there is more than one header line
+    header = "Epoch\tStart\tStop\tEvent\tChan\tTime\tSaO2\tDrop\tDuration"
+    event_lines = [header]*rng.choice([0, 1, 1, 1, 2])
+    for epoch in sorted(rng.randint(1, n_epochs) for _ in range(n_epochs//3)):
+        seconds = start_seconds + (epoch-1)*EPOCH_LENGTH + rng.randint(0, EPOCH_LENGTH-1)
+        scan = epoch*EPOCH_LENGTH*10
+        event = rng.choice(GAMMA_EVENTS)
+        # Some lines with values have the epoch but not the timestamp
+        timestamp = clock(seconds, ampm) if rng.random() < 0.95 or event not in ['Obs Apnea', 'Hypopnea', 'Central Apnea', 'SaO2'] else ''
+        if event in ['Obs Apnea', 'Hypopnea', 'Central Apnea']:
+            # Negative durations and durations divided by 100
+            duration = rng.choice([f"{rng.uniform(10, 60):.1f}", f"{rng.uniform(0.1, 0.6):.3f}", f"-{rng.uniform(10, 30):.1f}"])
+            spo2 = f"{rng.uniform(75, 95):.1f}" if rng.random() < 0.9 else f"-{rng.uniform(1, 6):.1f}"
+            values = [spo2, '', duration]
+        elif event == 'SaO2':
+            values = [f"{rng.uniform(75, 95):.0f}", f"{rng.uniform(3, 10):.0f}", f"{rng.uniform(0.05, 0.6):.2f}"]
+        else:
+            values = []
+        event_lines.append('\t'.join([str(epoch), str(scan), str(rng.randint(1, 3)), event, '1', timestamp]+values))
+
+    for suffix, lines in [('.log.txt', log_lines), ('.stg.txt', stage_lines), ('.sco.txt', event_lines)]:
+        with open(f"{path}{suffix}", 'w', encoding='utf-8') as output_file:
+            output_file.write('\n'.join(lines)+'\n')
+    return len(log_lines)+len(stage_lines)+len(event_lines)
+
+
+def write_corpus(folder, n_recordings, gamma_fraction=0.5, n_epochs=960, seed=0):
+    """Write a synthetic cohort in folder
+
+    Args:
+        folder (str): Output folder e.g. synthetic/polysomnography
+        n_recordings (int): Number of recordings
+        gamma_fraction (float, optional): Fraction of gamma recordings. Defaults to 0.5.
+        n_epochs (int, optional): Epochs of 30s of each recording. Defaults to 960 (8 hours).
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        List[str]: ids of the recordings
+        int: Total number of input lines
+    """
+    rng = random.Random(seed)
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    recordings = []
+    n_lines = 0
+    for i in range(n_recordings):
+        recording = f"wsc-visit{i%3+1}-{10000+i}-nsrr"
+        recording_epochs = max(int(n_epochs*rng.uniform(0.8, 1.2)), 10)
+        start_seconds = rng.randint(21*3600, 23*3600+1800)
+        if rng.random() < gamma_fraction:
+            n_lines += write_gamma(f"{folder}/{recording}", rng, recording_epochs, start_seconds, ampm=rng.random() < 0.2)
+        else:
+            n_lines += write_twin(f"{folder}/{recording}.allscore.txt", rng, recording_epochs, start_seconds)
+        recordings.append(recording)
+    return recordings, n_lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("folder", help="Output folder e.g. synthetic/polysomnography")
+    parser.add_argument("--recordings", type=int, default=100, help="Number of recordings. Defaults to 100")
+    parser.add_argument("--gamma-fraction", type=float, default=0.5, help="Fraction of gamma recordings. Defaults to 0.5")
+    parser.add_argument("--epochs", type=int, default=960, help="Average number of epochs of a recording. Defaults to 960 (8 hours)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed. Defaults to 0")
+    args = parser.parse_args()
+
+    recordings, n_lines = write_corpus(args.folder, args.recordings, args.gamma_fraction, args.epochs, args.seed)
+    print(f"Written {len(recordings)} recordings ({n_lines} lines) in {args.folder}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,54 +1,150 @@
 # -*- coding: utf-8 -*-
+# Modules that are slow to import (argparse, multiprocessing, sqlite3, hashlib, gzip, cProfile)
+# and the optional dependencies are imported by the functions that use them, so that the CLI and library users
+# that need only the parsers start quickly. See benchmarks/bench_startup.py
+import heapq
+import importlib
+import io
+import json
+import os
 import re
 import sys
 import warnings
-from copy import copy
-from csv import DictReader, DictWriter
+from array import array
+from collections import Counter
+from contextlib import contextmanager
+import csv
 from datetime import datetime, timedelta
-from glob import glob
-from importlib import resources
-from itertools import zip_longest
+from functools import lru_cache
+from itertools import chain, zip_longest
+from pathlib import Path
 from time import perf_counter
-from typing import Tuple, Union, List
+from typing import TYPE_CHECKING, Iterable, Iterator, NamedTuple, Tuple, Union, List
 
-from pathlib2 import Path
+if TYPE_CHECKING:
+    import argparse
 
 __version__ = "0.0.2"
 __author__      = "Luca Cerina"
 __copyright__   = "Copyright 2024, Luca Cerina"
 __email__       = "lccerina@duck.com"
 
-OUTPUT_HEADER = ["Timestamp","EventKey","Duration","Param1","Param2","Param3"]
-EMPTY_LINE = {k:v for (k,v) in zip(OUTPUT_HEADER, ['00:00:00.00', 'error', -1, 0, 0, 0])}
-map_event = lambda x,m: m.get(x, f"misc:{x}")
-
-gamma_STAGE_COLUMN = "User-Defined Stage"
-
-def datetime_sorter(start_time:datetime, input_time:datetime) -> int:
-    """Return distance from start of recording in seconds to sort output list in gamma parsing.
+@lru_cache(maxsize=None)
+def optional_module(name:str):
+    """Import an optional dependency (numpy, pyarrow.parquet, zstandard) on first use
 
     Args:
-        start_time (datetime): Start time of the recording from gamma log file
-        input_time (datetime): Input time to be aligned
+        name (str): Name of the module
 
     Returns:
-        int: Total seconds between start time and input
+        module: Imported module, None if not installed
+    """
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
+class Event(NamedTuple):
+    """Output line of a recording. Fields are in the order of the columns of the '.uniform.txt' file"""
+    Timestamp: str = '00:00:00.00'
+    EventKey: str = 'error'
+    Duration: Union[float, str] = -1
+    Param1: Union[float, str] = 0
+    Param2: Union[float, str] = 0
+    Param3: Union[float, str] = 0
+
+OUTPUT_HEADER = list(Event._fields)
+
+gamma_STAGE_COLUMN = "User-Defined Stage"
+gamma_STAGE_FIELDNAMES = ['Epoch', 'User-Defined Stage', 'CAST-Defined Stage']
+gamma_STAGE_MAP = {'7':'undefined','0':'w','1':'n1','2':'n2','3':'n3','4':'n3','5':'rem','6':'undefined'}
+gamma_EPOCH_LENGTH = 30
+# Lines of gamma files are almost sorted in time. Number of lines kept to fix the order while merging the files
+gamma_REORDER_BUFFER = 64
+
+# Precompiled patterns of the parsers. Twin patterns are selected by the leading event key of the line (text before ' -')
+_TWIN_RESPIRATORY_REGEX = re.compile(r"(?P<event_key>[\w]+\s[\w]+) - dur: (?P<Duration>[\d]+.[\d]) sec. - (?P<event_type>[\w]+\s?[\w]*) - desat (?P<Param1>[-]?[\d]+.[\d]|<n/a>)\s?[%]?")
+_TWIN_DESATURATION_REGEX = re.compile(r"(?P<event_key>[\w]+) - dur: (?P<Duration>[\d]+.[\d]) sec. - min (?P<Param1>[\d]+.[\d]) % - drop (?P<Param2>[-]?[\d]+.[\d]) %")
+_TWIN_GENERIC_REGEX = re.compile(r"(?P<event_key>([\w]+|[\w]+\s[\w]+))( - dur: (?P<Duration>[\d]+.[\d]) sec. |\s)- (?P<event_type>[\w]+\s?[\w]*)")
+_TWIN_EVENT_REGEX = {
+    'respiratory event': _TWIN_RESPIRATORY_REGEX,
+    'desaturation': _TWIN_DESATURATION_REGEX,
+    'arousal': _TWIN_GENERIC_REGEX,
+    'lm': _TWIN_GENERIC_REGEX,
+    'ekg events': _TWIN_GENERIC_REGEX,
+    'snore': _TWIN_GENERIC_REGEX,
+}
+_GAMMA_TIME_REGEX = re.compile(r"\d{1,2}:\d{2}:\d{2}")
+_DIGITS_REGEX = re.compile(r"\d+")
+_GAMMA_GAIN_REGEX = re.compile(r"(?P<event_key>([\w]+|[\w]+\s[\w]+)) \((?P<Param2>\d+)\) : gain\s?: (?P<Param1>\d+)")
+# Input and output files of a recording: id, visit, subject and suffix. See scan_recordings
+_RECORDING_FILE_REGEX = re.compile(r"(wsc-visit(\d?)-(\d+)-nsrr)(\.(?:allscore|log|sco|stg|uniform)\.txt(?:\.gz|\.zst)?|\.uniform\.(?:npz|parquet))")
+_GAMMA_EVENT_REGEX = re.compile(r"(?P<Epoch>\d+) (?:(-?\d+\s?-?\d+|)) (?:-?\d+) (?P<event_key>([a-z]+2?|[a-z]+\.?\s[a-z]+2?\s?[a-z^\d]*)) (?:\d+) (?P<timestamp>(\d{1,2}:\d{2}:\d{2}|))\s?(?P<Param1>-*\d*.?\d*)\s?(?P<Param2>-?\d*.?\d*)\s?(?P<Duration>(-?\d*.?\d*))")
+
+INPUT_SUFFIXES = ['.allscore.txt', '.log.txt', '.sco.txt', '.stg.txt']
+# Extensions of compressed input and output files. See open_input and open_output
+COMPRESSION_EXTENSIONS = ('.gz', '.zst')
+
+# Buffer of the output files, most recordings are written with a single write call. See atomic_open
+OUTPUT_BUFFER_SIZE = 1<<20
+
+# Folder of the compiled mappings. See load_mappings
+MAPPING_CACHE_FOLDER = os.environ.get('WSC_CLEAN_CACHE', os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'wsc_clean'))
+
+MANIFEST_FILENAME = ".wsc_clean_manifest.json"
+# Recordings that failed with --keep-going, processed again by --retry-failed
+QUARANTINE_FILENAME = ".wsc_clean_failed.json"
+MANIFEST_SAVE_INTERVAL = 50
+
+# Tables of the SQLite event index. Event keys are dictionary encoded, events are clustered by recording
+# (fast updates of reprocessed recordings) and indexed by event key (fast queries). See update_index and query_index
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS recordings (id INTEGER PRIMARY KEY, recording TEXT UNIQUE NOT NULL, visit TEXT, subject TEXT, size INTEGER, mtime_ns INTEGER);
+CREATE TABLE IF NOT EXISTS event_keys (id INTEGER PRIMARY KEY, event_key TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS events (recording_id INTEGER NOT NULL, line INTEGER NOT NULL, event_key_id INTEGER NOT NULL,
+    Timestamp TEXT, Duration REAL, Param1 REAL, Param2 REAL, Param3 REAL, PRIMARY KEY (recording_id, line)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS events_by_key ON events (event_key_id, recording_id);
+"""
+INDEX_OPERATORS = ('<', '<=', '>', '>=', '=', '!=')
+
+# Mappings loaded once in each worker process when recordings are processed in parallel
+_worker_mapping = None
+
+class Mapper:
+    """Map raw event keys with the maps in mappings.txt. If a map does not exist, the raw key is returned with a misc: prefix.
+       Keys are looked up directly in the interned maps and misc: keys are interned, so that output lines with the same event
+       key share the same string. Lookups are not counted, unmapped lines are counted by ParseReport for each recording.
+
+    Attributes:
+        mapping (dict): Destination value of each source value
     """
-    delta = input_time - start_time
-    while delta.days < 0:
-        delta += timedelta(days=1)
-    return delta.total_seconds()
+    def __init__(self, mapping:dict):
+        self.mapping = {sys.intern(k):sys.intern(v) for (k,v) in mapping.items()}
+
+    def map(self, raw:str) -> str:
+        """Map a raw (lowercase) event key
 
-def load_mappings() -> dict:
-    """Convert maps in mappings.txt file to a dictionary to be used later.
+        Args:
+            raw (str): Event key found in the annotation files
+
+        Returns:
+            str: Mapped event key. misc:<raw> if a map does not exist
+        """
+        value = self.mapping.get(raw)
+        if value is None:
+            value = sys.intern(f"misc:{raw}")
+        return value
+
+def parse_mappings(maps:List[str]) -> dict:
+    """Convert maps in the format of mappings.txt ('A|B|C', B and C are mapped to A) to a dict.
     Raise ValueError in case of badly formatted map
+
+    Args:
+        maps (List[str]): Lines of a mappings file
+
+    Returns:
+        dict: Destination value of each (lowercase) source value
     """
-    # TODO bit of a clunky path here
-    mapping_file = resources._get_package('wisconsinsc_cleaner').__path__._path[0]+'/mappings.txt'
-    assert Path(mapping_file).exists(), f"Mapping file {mapping_file} not found."
-    with open(mapping_file) as map_file:
-        maps = map_file.read().splitlines()
-    
     output = {}
     for map_line in maps:
         # Ignore comment lines
@@ -67,114 +163,574 @@ def load_mappings() -> dict:
         output.update({k.lower():v.lower() for (k,v) in zip_longest(source_values,[destination_value], fillvalue=destination_value)})
     return output
 
-def find_recordings(folder:str) -> List[str]:
+def _read_bundled_mappings() -> bytes:
+    """Content of the mappings.txt file distributed with the package. The file is read next to this module, as
+    wisconsinsc_cleaner is a namespace package and importlib.resources does not support them before Python 3.10"""
+    return Path(__file__).with_name('mappings.txt').read_bytes()
+
+def load_mappings(mapping_files:List[str]=None, cache:bool=True) -> Mapper:
+    """Load the maps of the mappings.txt file of the package, updated with the maps of mapping_files (later files win).
+    The merged maps are compiled once in a JSON file in MAPPING_CACHE_FOLDER, named after a hash of the content of all files,
+    so that a change in any of them compiles the maps again. Raise ValueError in case of badly formatted map
+
+    Args:
+        mapping_files (List[str], optional): Extra mapping files in the format of mappings.txt. Defaults to None.
+        cache (bool, optional): Read and write the compiled maps. Defaults to True.
+
+    Returns:
+        Mapper: Event keys mapping
+    """
+    import hashlib
+    sources = [_read_bundled_mappings()]
+    for mapping_file in mapping_files or []:
+        assert Path(mapping_file).exists(), f"Mapping file {mapping_file} not found."
+        with open(mapping_file, 'rb') as map_file:
+            sources.append(map_file.read())
+
+    sha = hashlib.sha256(__version__.encode('utf-8'))
+    for source in sources:
+        sha.update(hashlib.sha256(source).digest())
+    cache_filename = f"{MAPPING_CACHE_FOLDER}/mappings-{sha.hexdigest()[:32]}.json"
+    if cache:
+        try:
+            with open(cache_filename, 'r', encoding='utf-8') as cache_file:
+                return Mapper(json.load(cache_file))
+        except (OSError, ValueError):
+            pass
+
+    output = {}
+    for source in sources:
+        output.update(parse_mappings(source.decode('utf-8').splitlines()))
+    if cache:
+        # The cache is optional, e.g. with a read-only home folder
+        try:
+            Path(MAPPING_CACHE_FOLDER).mkdir(parents=True, exist_ok=True)
+            with atomic_open(cache_filename, 'w', encoding='utf-8') as cache_file:
+                json.dump(output, cache_file)
+        except OSError:
+            pass
+    return Mapper(output)
+
+class RecordingFiles(NamedTuple):
+    """Files of a recording found by scan_recordings"""
+    recording: str # id of the recording, relative to the scanned folder in recursive scans (e.g. 'visit1/wsc-visit1-10001-nsrr')
+    visit: str
+    subject: str
+    suffixes: frozenset # Suffixes of the files of the recording e.g. '.log.txt', '.sco.txt.gz', '.uniform.txt'
+
+    @property
+    def log_format(self) -> str:
+        """'twin' if the recording has an .allscore.txt file (compressed or not), 'gamma' otherwise"""
+        return 'twin' if any(suffix.startswith('.allscore.txt') for suffix in self.suffixes) else 'gamma'
+
+    def has_output(self, output_format:str='txt', output_compression:str=None) -> bool:
+        """Check if the '.uniform.txt' file (see uniform_filename) and the columnar file of output_format exist. See write_output"""
+        return uniform_filename('', output_compression) in self.suffixes and (output_format == 'txt' or f".uniform.{output_format}" in self.suffixes)
+
+def probe_recording(folder:str, recording:str) -> RecordingFiles:
+    """Find the input files of a single recording without scanning the folder, checking each input suffix on disk
+
+    Args:
+        folder (str): Path to the folder containing the log files
+        recording (str): id of the recording
+
+    Returns:
+        RecordingFiles: Input files of the recording. Output files are not listed
+    """
+    match = _RECORDING_FILE_REGEX.fullmatch(f"{Path(recording).name}.log.txt")
+    visit, subject = match.group(2, 3) if match is not None else ('', '')
+    suffixes = [suffix+extension for suffix in INPUT_SUFFIXES for extension in ('',)+COMPRESSION_EXTENSIONS]
+    return RecordingFiles(recording, visit, subject, frozenset(suffix for suffix in suffixes if Path(f"{folder}/{recording}{suffix}").exists()))
+
+def scan_recordings(folder:str, recursive:bool=False, visits:Iterable[int]=None, subjects:Iterable[str]=None) -> List[RecordingFiles]:
+    """Find all recordings "wsc-visitX-YYYYY-nsrr" with a ".allscore.txt" or ".log.txt" file, grouping the files of each recording.
+       Each directory is read once with os.scandir, files are not opened nor stat-ed
+
+    Args:
+        folder (str): Path to the folder containing the log files
+        recursive (bool, optional): Search also the subfolders (hidden folders are skipped). Defaults to False.
+        visits (Iterable[int], optional): Keep only these visits. Defaults to all visits.
+        subjects (Iterable[str], optional): Keep only these subject ids (e.g. '10001'). Defaults to all subjects.
+
+    Returns:
+        List[RecordingFiles]: Recordings sorted by id
+    """
+    assert(Path(folder).exists()), f"Folder {folder} not found."
+    visits = {str(visit) for visit in visits} if visits is not None else None
+    subjects = {str(subject) for subject in subjects} if subjects is not None else None
+    found = {}
+    folders = ['']
+    while folders:
+        subfolder = folders.pop()
+        with os.scandir(os.path.join(folder, subfolder) if subfolder else folder) as entries:
+            for entry in entries:
+                match = _RECORDING_FILE_REGEX.fullmatch(entry.name)
+                if match is None:
+                    if recursive and not entry.name.startswith('.') and entry.is_dir():
+                        folders.append(f"{subfolder}{entry.name}/")
+                    continue
+                recording, visit, subject, suffix = match.groups()
+                if (visits is not None and visit not in visits) or (subjects is not None and subject not in subjects):
+                    continue
+                found.setdefault((f"{subfolder}{recording}", visit, subject), set()).add(suffix)
+    return [RecordingFiles(*key, frozenset(suffixes)) for (key, suffixes) in sorted(found.items())
+            if any(suffix.startswith(('.allscore.txt', '.log.txt')) for suffix in suffixes)]
+
+def find_recordings(folder:str, recursive:bool=False, visits:Iterable[int]=None, subjects:Iterable[str]=None) -> List[str]:
     """Extract all files that match "wsc-visitX-YYYYY-nsrr" ending with ".allscore.txt" or ".log.txt"
 
     Args:
         folder (str): Path to the folder containing the log files
+        recursive (bool, optional): Search also the subfolders. See scan_recordings
+        visits (Iterable[int], optional): Keep only these visits. Defaults to all visits.
+        subjects (Iterable[str], optional): Keep only these subject ids. Defaults to all subjects.
 
     Returns:
         List[str]: List of recordings
     """
-    assert(Path(folder).exists()), f"Folder {folder} not found."
-    recordings = [re.findall(r"[a-z]+(?:/|\\)(wsc-visit\d?-\d+-nsrr).(?:log|allscore).txt", x)[0] for x in glob(f"{folder}*.allscore.txt")+glob(f"{folder}*.log.txt")]
-    return recordings
+    return [recording.recording for recording in scan_recordings(folder, recursive, visits, subjects)]
+
+def load_subjects(filename:str) -> List[str]:
+    """Read subject ids from a text file, separated by spaces, commas or new lines. Lines starting with # are ignored
+
+    Args:
+        filename (str): Text file with the subject ids
 
-def parse_event_twin(event_string:str, mapping:dict) -> Union[dict, None]:
+    Returns:
+        List[str]: Subject ids
+    """
+    with open(filename, 'r', encoding='utf-8') as subjects_file:
+        return [subject for line in subjects_file if not line.startswith('#') for subject in re.split(r"[\s,]+", line) if subject]
+
+def parse_event_twin(event_string:str, mapping:Mapper) -> Union[tuple, None]:
     """Parse events with duration and extra parameters from twin/allscore log files.
        Return None in case of errors
 
     Args:
         event_string (str): String description of the event
-        mapping (dict): Dictionary to map event keys. See mappings.txt
+        mapping (Mapper): Event keys mapping. See mappings.txt
 
     Returns:
-        dict: Mapped event with duration and params. None in case of errors
+        tuple: EventKey, Duration, Param1, Param2 and Param3 fields of the output line (see Event). None in case of errors
     """
-    output = {}
-    # Select matcher
-    if event_string.startswith('respiratory event'):
-        regex = r"(?P<event_key>[\w]+\s[\w]+) - dur: (?P<Duration>[\d]+.[\d]) sec. - (?P<event_type>[\w]+\s?[\w]*) - desat (?P<Param1>[-]?[\d]+.[\d]|<n/a>)\s?[%]?"
-    elif event_string.startswith('desat'):
-        regex = r"(?P<event_key>[\w]+) - dur: (?P<Duration>[\d]+.[\d]) sec. - min (?P<Param1>[\d]+.[\d]) % - drop (?P<Param2>[-]?[\d]+.[\d]) %"
-    elif any(event_string.startswith(x) for x in ['arousal', 'lm', 'ekg', 'snore']):
-        regex = r"(?P<event_key>([\w]+|[\w]+\s[\w]+))( - dur: (?P<Duration>[\d]+.[\d]) sec. |\s)- (?P<event_type>[\w]+\s?[\w]*)"
-    else:
+    # Select matcher from the leading event key
+    regex = _TWIN_EVENT_REGEX.get(event_string.split(' -', 1)[0])
+    if regex is None:
         return None
 
     # Parse string
-    match = re.match(regex,event_string)
+    match = regex.match(event_string)
     if match:
         try:
             # Fill results
             match_dict = match.groupdict()
-            output['EventKey'] = map_event(f"{match_dict['event_key']} {match_dict.get('event_type','')}".strip(), mapping)
-            output['Duration'] = match_dict.get('Duration', 3.0) # Default for some events in twin recordings (e.g. arousals)
-            for i in range(1, 4):
-                output[f'Param{i}'] = match_dict.get(f'Param{i}', 0)
+            event_key = mapping.map(f"{match_dict['event_key']} {match_dict.get('event_type','')}".strip())
+            duration = match_dict.get('Duration', 3.0) # Default for some events in twin recordings (e.g. arousals)
+            return (event_key, duration, match_dict.get('Param1', 0), match_dict.get('Param2', 0), match_dict.get('Param3', 0))
         except Exception:
             return None
-        return output
     else:
         return None
         
-def process_twin_log(recording:str, input_filename:str, output_filename:str, mapping:dict) -> Tuple[bool, set]:
+def timestamp_seconds(timestamp:str) -> Union[float, None]:
+    """Convert a 'hh:mm:ss[.ms]' timestamp of the output to seconds from midnight
+
+    Args:
+        timestamp (str): Timestamp string
+
+    Returns:
+        float: Seconds from midnight. None if the timestamp is not formatted correctly
+    """
+    try:
+        hours, minutes, seconds = timestamp.split(':')
+        return int(hours)*3600 + int(minutes)*60 + float(seconds)
+    except ValueError:
+        return None
+
+def collapse_stage_lines(output_lines:Iterable[Event], epoch_length:int=gamma_EPOCH_LENGTH) -> Iterator[Event]:
+    """Keep only the sleep stage lines where the stage changes and fill their duration until the next transition.
+       Lines following a transition are buffered until the duration is known, so the order of the output is preserved.
+
+    Args:
+        output_lines (Iterable[Event]): Output lines sorted by time
+        epoch_length (int, optional): Length of an epoch in seconds, added to the last stage. Defaults to 30.
+
+    Yields:
+        Event: Output lines with collapsed stages
+    """
+    stage_line = None
+    stage_start = stage_end = None
+    buffer = []
+    for output_line in output_lines:
+        if not output_line.EventKey.startswith('stage:'):
+            if stage_line is None:
+                yield output_line
+            else:
+                buffer.append(output_line)
+            continue
+
+        seconds = timestamp_seconds(output_line.Timestamp)
+        if stage_line is not None and output_line.EventKey==stage_line.EventKey:
+            stage_end = seconds
+            continue
+        if stage_line is not None:
+            if stage_start is not None and seconds is not None:
+                stage_line = stage_line._replace(Duration=round((seconds-stage_start) % 86400, 2))
+            yield stage_line
+            yield from buffer
+            buffer = []
+        stage_line = output_line
+        stage_start = stage_end = seconds
+
+    if stage_line is not None:
+        if stage_start is not None and stage_end is not None:
+            stage_line = stage_line._replace(Duration=round((stage_end-stage_start) % 86400 + epoch_length, 2))
+        yield stage_line
+        yield from buffer
+
+class PhaseTimer:
+    """Time spent in each phase of the processing of a recording (e.g. parsing of a file, merge, write).
+       Lines flow lazily through the phases, so the time of a phase excludes the time spent in the phases it consumes.
+       A disabled timer does not wrap anything and has no overhead.
+
+    Attributes:
+        enabled (bool): True if time is measured
+        times (Counter): Seconds spent in each phase
+        lines (Counter): Lines produced by each phase
+    """
+    def __init__(self, enabled:bool=True):
+        self.enabled = enabled
+        self.times = Counter()
+        self.lines = Counter()
+        self._phase = None
+        self._start = perf_counter()
+
+    def switch(self, phase:str) -> str:
+        """Attribute the elapsed time to the current phase and start a new phase. Return the previous phase"""
+        now = perf_counter()
+        if self._phase is not None:
+            self.times[self._phase] += now-self._start
+        self._start = now
+        previous, self._phase = self._phase, phase
+        return previous
+
+    def wrap(self, items:Iterable, phase:str) -> Iterable:
+        """Attribute the time spent to produce each item to phase and count the items"""
+        if not self.enabled:
+            return items
+        return self._wrap(iter(items), phase)
+
+    def _wrap(self, items:Iterator, phase:str) -> Iterator:
+        while True:
+            previous = self.switch(phase)
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                self.switch(previous)
+            self.lines[phase] += 1
+            yield item
+
+    @contextmanager
+    def phase(self, phase:str):
+        """Attribute the time spent in the context to phase"""
+        if not self.enabled:
+            yield
+            return
+        previous = self.switch(phase)
+        try:
+            yield
+        finally:
+            self.switch(previous)
+
+class ParseReport:
+    """Problems found while parsing a recording. Filled by the iter_twin_events and iter_gamma_events generators
+
+    Attributes:
+        recording (str): id of the recording
+        errors (list): (filename, line number, line) of the lines that could not be parsed
+        unmapped (Counter): Number of lines of each value that was not mapped (misc: prefix)
+        timer (PhaseTimer): Time spent in each phase. Disabled by default
+    """
+    def __init__(self, recording:str, timer:PhaseTimer=None):
+        self.recording = recording
+        self.errors = []
+        self.unmapped = Counter()
+        self.timer = timer if timer is not None else PhaseTimer(enabled=False)
+
+    @property
+    def no_error(self) -> bool:
+        """True if parsing concluded with no errors"""
+        return len(self.errors)==0
+
+    def add_unmapped(self, output_line:Event):
+        """Log non mapped / misc lines"""
+        if output_line.EventKey.startswith('misc'):
+            self.unmapped[output_line.EventKey] += 1
+
+def find_input(recording_path:str, suffix:str, suffixes:Iterable[str]=None) -> Union[str, None]:
+    """Return the input file of a recording with suffix, or its compressed version (e.g. '.log.txt.gz') if any. See COMPRESSION_EXTENSIONS
+
+    Args:
+        recording_path (str): Path of the recording without suffixes e.g. wsc-visit1-100000-nsrr
+        suffix (str): Uncompressed suffix e.g. '.log.txt'
+        suffixes (Iterable[str], optional): Suffixes of the files of the recording. See RecordingFiles. Defaults to checking the files on disk.
+
+    Returns:
+        str: Existing input file. None if no version of the file exists
+    """
+    for extension in ('',)+COMPRESSION_EXTENSIONS:
+        filename = recording_path+suffix+extension
+        if (suffix+extension in suffixes) if suffixes is not None else Path(filename).exists():
+            return filename
+    return None
+
+def open_input(filename:str, **kwargs) -> io.TextIOBase:
+    """Open an input file as text. Files ending with '.gz' or '.zst' are decompressed while they are read
+
+    Args:
+        filename (str): Input file
+        **kwargs: Arguments of open e.g. encoding
+
+    Returns:
+        io.TextIOBase: Text file object
+    """
+    if filename.endswith('.gz'):
+        import gzip
+        return gzip.open(filename, 'rt', **kwargs)
+    if filename.endswith('.zst'):
+        zstd = optional_module('zstandard')
+        if zstd is None:
+            raise ImportError(f"Reading {filename} requires the zstandard package")
+        return io.TextIOWrapper(zstd.ZstdDecompressor().stream_reader(open(filename, 'rb'), read_across_frames=True), **kwargs)
+    return open(filename, 'r', **kwargs)
+
+@contextmanager
+def atomic_open(filename:str, mode:str='w', fsync:bool=False, **kwargs):
+    """Open a temporary file next to filename with a large buffer and replace filename with it when completely written.
+       If an exception is raised the temporary file is removed and filename is left untouched.
+
+    Args:
+        filename (str): Output file
+        mode (str, optional): 'w' or 'wb'. Defaults to 'w'.
+        fsync (bool, optional): Flush the file to disk before replacing filename. Defaults to False.
+        **kwargs: Arguments of open e.g. encoding
+
+    Yields:
+        file: Temporary file object
+    """
+    temp_filename = f"{filename}.tmp"
+    try:
+        with open(temp_filename, mode, buffering=OUTPUT_BUFFER_SIZE, **kwargs) as output_file:
+            yield output_file
+            if fsync:
+                output_file.flush()
+                os.fsync(output_file.fileno())
+        os.replace(temp_filename, filename)
+    except BaseException:
+        if Path(temp_filename).exists():
+            os.remove(temp_filename)
+        raise
+
+@contextmanager
+def open_output(filename:str, fsync:bool=False, **kwargs):
+    """Open an output text file with atomic_open. Files ending with '.gz' or '.zst' are compressed while they are written
+
+    Args:
+        filename (str): Output file
+        fsync (bool, optional): Flush the file to disk before replacing filename. Defaults to False.
+        **kwargs: Arguments of open e.g. encoding
+
+    Yields:
+        io.TextIOBase: Text file object
+    """
+    if not filename.endswith(COMPRESSION_EXTENSIONS):
+        with atomic_open(filename, 'w', fsync, **kwargs) as output_file:
+            yield output_file
+        return
+
+    zstd = optional_module('zstandard') if filename.endswith('.zst') else None
+    if filename.endswith('.zst') and zstd is None:
+        raise ImportError(f"Writing {filename} requires the zstandard package")
+    with atomic_open(filename, 'wb', fsync) as raw_file:
+        if filename.endswith('.gz'):
+            import gzip
+            # Fixed mtime, so that the same content gives the same file
+            compressed_file = gzip.GzipFile(Path(filename).name, 'wb', fileobj=raw_file, mtime=0)
+        else:
+            compressed_file = zstd.ZstdCompressor().stream_writer(raw_file, closefd=False)
+        with io.TextIOWrapper(compressed_file, **kwargs) as output_file:
+            yield output_file
+
+class ColumnarOutput:
+    """Typed columns of the output lines of a recording, saved as .npz (NumPy) or .parquet (Arrow) files.
+       Timestamps are stored as int seconds since the first line, event keys are dictionary encoded
+       and Duration/Param1-3 are float32 (NaN if missing or not numeric).
+    """
+    def __init__(self):
+        self.start_seconds = None
+        self.timestamp = array('i')
+        self.event_code = array('i')
+        self.event_keys = {}
+        self.values = {k:array('f') for k in OUTPUT_HEADER[2:]}
+
+    def append(self, output_line:Event):
+        """Add an output line to the columns"""
+        seconds = timestamp_seconds(output_line.Timestamp)
+        if seconds is None:
+            seconds = self.start_seconds or 0
+        if self.start_seconds is None:
+            self.start_seconds = seconds
+        self.timestamp.append(int((seconds-self.start_seconds) % 86400))
+        self.event_code.append(self.event_keys.setdefault(output_line.EventKey, len(self.event_keys)))
+        for (column, value) in zip(self.values.values(), output_line[2:]):
+            column.append(_to_float(value))
+
+    def save(self, filename:str, output_format:str, fsync:bool=False):
+        """Save the columns to filename in npz or parquet format. See atomic_open"""
+        np = optional_module('numpy')
+        timestamp = np.frombuffer(self.timestamp, dtype=np.int32) if len(self.timestamp)>0 else np.zeros(0, dtype=np.int32)
+        event_code = np.frombuffer(self.event_code, dtype=np.int32) if len(self.event_code)>0 else np.zeros(0, dtype=np.int32)
+        values = {k:(np.frombuffer(v, dtype=np.float32) if len(v)>0 else np.zeros(0, dtype=np.float32)) for (k,v) in self.values.items()}
+        event_keys = list(self.event_keys)
+        if output_format == 'npz':
+            with atomic_open(filename, 'wb', fsync) as output_file:
+                np.savez_compressed(output_file, Timestamp=timestamp, EventCode=event_code, EventKeys=np.array(event_keys, dtype=str), **values)
+        elif output_format == 'parquet':
+            pa, pq = optional_module('pyarrow'), optional_module('pyarrow.parquet')
+            table = pa.table(dict(
+                Timestamp=pa.array(timestamp),
+                EventKey=pa.DictionaryArray.from_arrays(pa.array(event_code), pa.array(event_keys, type=pa.string())),
+                **{k:pa.array(v) for (k,v) in values.items()}))
+            with atomic_open(filename, 'wb', fsync) as output_file:
+                pq.write_table(table, output_file)
+        else:
+            raise ValueError(f"Unknown columnar output format {output_format}")
+
+def _to_float(value) -> float:
+    """Convert a value of the output lines to float, NaN if missing or not numeric"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+def uniform_filename(recording_path:str, output_compression:str=None) -> str:
+    """Name of the output file of a recording e.g. '.uniform.txt' or '.uniform.txt.gz' with output_compression 'gz'"""
+    return f"{recording_path}.uniform.txt" + (f".{output_compression}" if output_compression is not None else '')
+
+def columnar_filename(output_filename:str, output_format:str) -> str:
+    """Name of the columnar file written alongside a '.uniform.txt' file (compressed or not) e.g. '.uniform.npz'"""
+    for extension in COMPRESSION_EXTENSIONS:
+        if output_filename.endswith(extension):
+            output_filename = output_filename[:-len(extension)]
+    return f"{output_filename[:-len('.txt')] if output_filename.endswith('.txt') else output_filename}.{output_format}"
+
+def _write_csv(output_lines:Iterable[Event], output_file:io.TextIOBase, columns:ColumnarOutput=None):
+    """Write the header and the output lines as CSV to an open file, adding them also to columns if any"""
+    # Write output header
+    writer = csv.writer(output_file, lineterminator='\n')
+    writer.writerow(OUTPUT_HEADER)
+    # Write lines
+    if columns is None:
+        writer.writerows(output_lines)
+    else:
+        for output_line in output_lines:
+            writer.writerow(output_line)
+            columns.append(output_line)
+
+def write_output(output_lines:Iterable[Event], output_filename:str, output_format:str='txt', fsync:bool=False):
+    """Write output lines to the '.uniform.txt' file. With a columnar format, the lines are also saved as typed columns
+       in a file next to it. See ColumnarOutput. Files are replaced only when completely written, see atomic_open
+
+    Args:
+        output_lines (Iterable[Event]): Output lines
+        output_filename (str): Output '.uniform.txt' log file. Compressed if it ends with '.gz' or '.zst', see open_output
+        output_format (str, optional): 'txt', 'npz' or 'parquet'. Defaults to 'txt'.
+        fsync (bool, optional): Flush the files to disk before replacing them. Defaults to False.
+    """
+    columns = ColumnarOutput() if output_format != 'txt' else None
+    with open_output(output_filename, fsync, encoding='utf-8') as output_file:
+        _write_csv(output_lines, output_file, columns)
+    if columns is not None:
+        columns.save(columnar_filename(output_filename, output_format), output_format, fsync)
+
+def iter_twin_events(input_filename:str, mapping:Mapper, report:ParseReport=None) -> Iterator[Event]:
+    """Parse lines from twin/allscore files lazily, one output line for each event in the file.
+       Lines that cannot be parsed are skipped and logged in the report.
+
+    Args:
+        input_filename (str): Input log file e.g wsc-visit1-100000-nsrr.allscore.txt. '.gz' and '.zst' files are decompressed while read
+        mapping (Mapper): Event keys mapping. See mappings.txt
+        report (ParseReport, optional): Report of errors and unmapped lines. Defaults to None.
+
+    Yields:
+        Event: Output line
+    """
+    if report is None:
+        report = ParseReport(Path(input_filename).name.split('.')[0])
+
+    with open_input(input_filename, encoding='utf-8', errors='ignore') as input_file:
+        yield from _iter_twin_lines(input_file, input_filename, mapping, report)
+
+def _iter_twin_lines(input_file:Iterable[str], input_filename:str, mapping:Mapper, report:ParseReport) -> Iterator[Event]:
+    """Parse lines of twin/allscore files from an open file (e.g. sys.stdin). Yield one output line for each event"""
+    for line_number, input_line in enumerate(input_file, start=1):
+        # Lowercase
+        input_line = input_line.lower()
+        # Split columns
+        input_line_split = input_line.strip('\n \t').split('\t')
+        if len(input_line_split)<=1:
+            continue
+
+        # Timestamp
+        timestamp = input_line_split[0]
+
+        # Primary event key
+        event_string_split = input_line_split[1].split(' -')
+        event_key = event_string_split[0]
+        # Parse events with or without durations
+        if event_key in _TWIN_EVENT_REGEX and len(event_string_split)>1:
+            parsed_line = parse_event_twin(input_line_split[1], mapping)
+            if parsed_line is None:
+                print(f"Parsing error twin in line: {input_line_split[1]}", file=sys.stderr)
+                report.errors.append((input_filename, line_number, input_line_split[1]))
+                continue
+            output_line = Event(timestamp, *parsed_line)
+        else:
+            output_line = Event(timestamp, mapping.map(input_line_split[1]))
+
+        report.add_unmapped(output_line)
+        yield output_line
+
+def process_twin_log(recording:str, input_filename:str, output_filename:str, mapping:Mapper, collapse_stages:bool=False, output_format:str='txt', report:ParseReport=None, fsync:bool=False) -> Tuple[bool, Counter]:
     """Parse lines from twin/allscore files. This function receives the filename ending as 'allscore.txt'
 
     Args:
         recording (str): id of the recording
         input_filename (str): Input log file e.g wsc-visit1-100000-nsrr.allscore.txt
         output_filename (str): Output '.uniform.txt' log file
-        mapping (dict): Dictionary to map event keys. See mappings.txt
+        mapping (Mapper): Event keys mapping. See mappings.txt
+        collapse_stages (bool, optional): Write only stage transitions with their duration. See collapse_stage_lines
+        output_format (str, optional): Columnar format written alongside the output file. See write_output
+        report (ParseReport, optional): Report of errors, unmapped lines and phase times. Defaults to a new report.
+        fsync (bool, optional): Flush the output files to disk before replacing them. See write_output
 
     Returns:
         bool: True if parsing concluded with no errors
-        set: Set of values that were not mapped (misc: prefix)
-    """
-    no_error = True
-    unmapped = set()
-
-    assert input_filename.endswith('allscore.txt'), f"Error in twin parser. Expected an allscore log file, got {input_filename}"
-    with open(input_filename, 'r', encoding='utf-8', errors='ignore') as input_file, open(output_filename, 'w', encoding='utf-8') as output_file:
-        # Write output header
-        writer = DictWriter(output_file, fieldnames=OUTPUT_HEADER, lineterminator='\n')
-        writer.writeheader()
-        # Parse lines
-        for input_line in input_file:
-            # Lowercase
-            input_line = input_line.lower()
-            # Split columns
-            input_line_split = input_line.strip('\n \t').split('\t')
-            if len(input_line_split)<=1:
-                continue
-            
-            # Create output line
-            output_line = copy(EMPTY_LINE)
-
-            # Timestamp
-            timestamp = input_line_split[0]
-            output_line['Timestamp'] = timestamp
-
-            # Primary event key
-            event_string_split = input_line_split[1].split(' -')
-            event_key = event_string_split[0]
-            # Parse events with or without durations
-            if event_key in ['arousal', 'respiratory event', 'desaturation', 'lm', 'ekg events', 'snore'] and len(event_string_split)>1:
-                parsed_line = parse_event_twin(input_line_split[1], mapping)
-                if parsed_line is None:
-                    print(f"Parsing error twin in line: {input_line_split[1]}")
-                    no_error = False
-                    continue
-                output_line.update(parsed_line)
-            else:
-                output_line['EventKey'] = map_event(input_line_split[1], mapping)
-            
-            # Log non mapped / misc lines
-            if output_line['EventKey'].startswith('misc'):
-                unmapped.add(f"{recording} - {output_line['Timestamp']} - {output_line['EventKey']}")
-            writer.writerow(output_line)
+        Counter: Number of lines of each value that was not mapped (misc: prefix)
+    """
+    if report is None:
+        report = ParseReport(recording)
+
+    assert input_filename.endswith(tuple('allscore.txt'+extension for extension in ('',)+COMPRESSION_EXTENSIONS)), f"Error in twin parser. Expected an allscore log file, got {input_filename}"
+    output_lines = report.timer.wrap(iter_twin_events(input_filename, mapping, report), 'allscore')
+    if collapse_stages:
+        output_lines = report.timer.wrap(collapse_stage_lines(output_lines), 'collapse')
+    with report.timer.phase('write'):
+        write_output(output_lines, output_filename, output_format, fsync)
 
-    return no_error, unmapped
+    return report.no_error, report.unmapped
 
 def parse_timestamp_gamma(timestamp_str:str, start_time:datetime=None, timestamp_correction:timedelta=timedelta(seconds=0)) -> Union[datetime,None]:
     """Parse timestamps in gamma logs using the hh:mm:ss string or the epoch if start time is available.
@@ -188,47 +744,39 @@ def parse_timestamp_gamma(timestamp_str:str, start_time:datetime=None, timestamp
         datetime: parsed datetime
         None: error in parsing
     """
-    timestamp_split = re.sub("\s+", " ", timestamp_str).split()
-    if len(timestamp_split)<=2 and re.match(r"\d{1,2}:\d{2}:\d{2}", timestamp_split[0]):
+    timestamp_split = timestamp_str.split()
+    if len(timestamp_split)<=2 and _GAMMA_TIME_REGEX.match(timestamp_split[0]):
         return datetime.strptime(timestamp_split[0], "%H:%M:%S")+timestamp_correction
     elif len(timestamp_split)<=2 and start_time is not None:
-        if re.match(r"\d+", timestamp_split[0]):
+        if _DIGITS_REGEX.match(timestamp_split[0]):
             return start_time+timedelta(seconds=(int(timestamp_split[0])-1)*30)
-        elif len(timestamp_split)==2 and re.match(r"\d+", timestamp_split[1]):
+        elif len(timestamp_split)==2 and _DIGITS_REGEX.match(timestamp_split[1]):
             return start_time+timedelta(seconds=(int(timestamp_split[1])-1)*30)
         else:
             return None
     else:
         return None
     
-def parse_gain_gamma(event_string:str) -> Union[dict, None]:
+def parse_gain_gamma(event_string:str) -> Union[Tuple[str, str, str], None]:
     """Parse lines in gamma files referring to gain changes
 
     Args:
         event_string (str): Input string in the form: '<sensor> (<channel>) : gain : <value>'
 
     Returns:
-        Union[dict, None]: Parsed line. None in case of error
+        Tuple[str, str, str]: EventKey, Param1 (gain) and Param2 (channel) fields of the output line (see Event). None in case of error
     """
-    output = {}
     # Remove extra whitespaces
-    event_string_sub = re.sub("\s+", " ", event_string).strip("\t ")
-    # Define regex
-    regex = r"(?P<event_key>([\w]+|[\w]+\s[\w]+)) \((?P<Param2>\d+)\) : gain\s?: (?P<Param1>\d+)"
+    event_string_sub = " ".join(event_string.split())
 
     # Match string
-    match = re.match(regex,event_string_sub)
+    match = _GAMMA_GAIN_REGEX.match(event_string_sub)
     if match:
-        # Fill results
-        match_dict = match.groupdict()
-        output['EventKey'] = f"gain:{match_dict['event_key']}"
-        output['Param1'] = match_dict['Param1']
-        output['Param2'] = match_dict['Param2']
-        return output
+        return f"gain:{match['event_key']}", match['Param1'], match['Param2']
     else:
         return None
 
-def parse_event_gamma(event_string:str, start_time:datetime, timestamp_correction:timedelta, mapping:dict) -> Union[dict, None]:
+def parse_event_gamma(event_string:str, start_time:datetime, timestamp_correction:timedelta, mapping:Mapper) -> Union[Tuple[datetime, Event], None]:
     """Parse events with duration and extra parameters from Gamma/.sco log files.
        Return None in case of errors
 
@@ -236,271 +784,1026 @@ def parse_event_gamma(event_string:str, start_time:datetime, timestamp_correctio
         event_string (str): String description of the event
         start_time (datetime, optional): Start time of the recording from the first line of the log file. Defaults to None.
         timestamp_correction (timedelta, optional): Correction for am/pm logs
-        mapping (dict): Dictionary to map event keys. See mappings.txt
+        mapping (Mapper): Event keys mapping. See mappings.txt
 
     Returns:
-        dict: Mapped event with duration and params. None in case of errors
+        datetime: Time of the event, to sort the events of the recording
+        Event: Output line with the mapped event, duration and params
+        None: error in parsing
     """
-    # Create output line
-    output_line = copy(EMPTY_LINE)
-
-    # Regular expression
-    regex = r"(?P<Epoch>\d+) (?:(-?\d+\s?-?\d+|)) (?:-?\d+) (?P<event_key>([a-z]+2?|[a-z]+\.?\s[a-z]+2?\s?[a-z^\d]*)) (?:\d+) (?P<timestamp>(\d{1,2}:\d{2}:\d{2}|))\s?(?P<Param1>-*\d*.?\d*)\s?(?P<Param2>-?\d*.?\d*)\s?(?P<Duration>(-?\d*.?\d*))"
-
     # Remove extra whitespaces
-    event_string_sub = re.sub("\s+", " ", event_string).strip("\t ").lower()
-    match = re.fullmatch(regex, event_string_sub)
+    event_string_sub = " ".join(event_string.split()).lower()
+    match = _GAMMA_EVENT_REGEX.fullmatch(event_string_sub)
     if match:
         # Fill results
         match_dict = match.groupdict()
 
-        output_line['EventKey'] = map_event(f"gamma_{match_dict['event_key']}", mapping)
+        event_key = mapping.map(f"gamma_{match_dict['event_key']}")
         # Get timestamp
-        output_line['Timestamp'] = parse_timestamp_gamma(f"{match_dict['timestamp']} {match_dict['Epoch']}", start_time, timestamp_correction)
+        timestamp = parse_timestamp_gamma(f"{match_dict['timestamp']} {match_dict['Epoch']}", start_time, timestamp_correction)
         # Move Param2 to Duration for partial matches
         if match_dict['Param2']!='' and match_dict['Duration']=='':
             match_dict['Duration'] = match_dict.pop('Param2')
         # Checks on Duration sometimes apneas and desaturations are divided by 100
-        if match_dict['Duration']=='' and any(output_line['EventKey'].startswith(x) for x in ['arousal', 'leg_movement', 'snore', 'artifact']):
-            output_line['Duration'] = 3
+        if match_dict['Duration']=='' and any(event_key.startswith(x) for x in ['arousal', 'leg_movement', 'snore', 'artifact']):
+            duration = 3
         else:
             match_dict['Duration'] = float(match_dict['Duration'])
-            if (match_dict['Duration'] < 10 and output_line['EventKey']=='desaturation') or (match_dict['Duration'] < 5):
-                output_line['Duration'] = match_dict['Duration']*100
+            if (match_dict['Duration'] < 10 and event_key=='desaturation') or (match_dict['Duration'] < 5):
+                duration = match_dict['Duration']*100
             else:
-                output_line['Duration'] = match_dict['Duration']
-        # Add Params
-        for i in range(1, 4):
-            output_line[f'Param{i}'] = match_dict.get(f'Param{i}', 0)
+                duration = match_dict['Duration']
 
-        return output_line
+        return timestamp, Event(timestamp.strftime("%H:%M:%S.00"), event_key, duration, *[match_dict.get(f'Param{i}', 0) for i in range(1, 4)])
     else:
         return None
 
+def format_seconds(seconds:int) -> str:
+    """Format seconds from midnight as a 'hh:mm:ss.00' timestamp, wrapping at midnight
+
+    Args:
+        seconds (int): Seconds from midnight
+
+    Returns:
+        str: Formatted timestamp
+    """
+    minutes, seconds = divmod(seconds % 86400, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}.00"
+
+def read_stages_gamma(stage_filename:str, start_seconds:int) -> Tuple[List[int], List[str], List[str]]:
+    """Read sleep stages from gamma/.stg files. Timestamps are computed from the epoch number in integer seconds,
+       the whole column is vectorized if NumPy is available.
+
+    Args:
+        stage_filename (str): Input stage file e.g wsc-visit1-100000-nsrr.stg.txt
+        start_seconds (int): Start time of the recording in seconds from midnight
+
+    Returns:
+        List[int]: Seconds from the start of the recording of each epoch
+        List[str]: Timestamps of each epoch
+        List[str]: Stage event keys (stage: prefix)
+    """
+    stage_column = gamma_STAGE_FIELDNAMES.index(gamma_STAGE_COLUMN)
+    stage_keys = {k:f"stage:{v}" for (k,v) in gamma_STAGE_MAP.items()}
+
+    epochs = []
+    event_keys = []
+    with open_input(stage_filename) as stage_file:
+        for stage_line in stage_file:
+            stage_line_split = stage_line.rstrip('\n').split('\t')
+            # Header line is in most files, but not all of them. Skip it and empty lines
+            if stage_line_split[0]=='Epoch' or stage_line_split==['']:
+                continue
+            epochs.append(stage_line_split[0])
+            event_keys.append(stage_keys.get(stage_line_split[stage_column], 'stage:undefined') if len(stage_line_split)>stage_column else 'stage:undefined')
+
+    np = optional_module('numpy')
+    if np is not None and len(epochs)>0:
+        offsets = (np.array(epochs, dtype=np.int64)-1)*gamma_EPOCH_LENGTH
+        minutes, seconds = np.divmod((offsets+start_seconds) % 86400, 60)
+        hours, minutes = np.divmod(minutes, 60)
+        timestamps = np.char.add(np.char.add(np.char.add(np.char.add(np.char.add(
+            np.char.zfill(hours.astype(str), 2), ':'), np.char.zfill(minutes.astype(str), 2)), ':'), np.char.zfill(seconds.astype(str), 2)), '.00')
+        return offsets.tolist(), timestamps.tolist(), event_keys
+
+    offsets = [(int(epoch)-1)*gamma_EPOCH_LENGTH for epoch in epochs]
+    timestamps = [format_seconds(start_seconds+offset) for offset in offsets]
+    return offsets, timestamps, event_keys
+
+class LineParseError(ValueError):
+    """A line of an input file cannot be parsed. The line is already logged in the errors of the report"""
+
+class OutOfOrderError(ValueError):
+    """A line is displaced beyond the reorder buffer. See reorder_by_time"""
+
+def reorder_by_time(items:Iterable[tuple], buffer_size:Union[int, None]=gamma_REORDER_BUFFER) -> Iterator[tuple]:
+    """Sort an almost sorted stream of (seconds, ...) tuples with a small heap.
+       Raise OutOfOrderError if an item is displaced by more than buffer_size positions, as the items before it were already yielded.
+
+    Args:
+        items (Iterable[tuple]): Tuples starting with the time of the line
+        buffer_size (int, optional): Number of items kept in the reorder buffer. None sorts all the items at once.
+
+    Yields:
+        tuple: Items in time order
+    """
+    if buffer_size is None:
+        yield from sorted(items)
+        return
+
+    buffer = []
+    last_item = None
+    for item in items:
+        if len(buffer) < buffer_size:
+            heapq.heappush(buffer, item)
+            continue
+        item = heapq.heappushpop(buffer, item)
+        if last_item is not None and item < last_item:
+            raise OutOfOrderError(f"Line out of order beyond the reorder buffer at {item[0]}s from start")
+        last_item = item
+        yield item
+    while buffer:
+        yield heapq.heappop(buffer)
+
+def split_log_line_gamma(log_line:str) -> Union[List[str], None]:
+    """Lowercase and split the columns of a line of gamma/.log files
+
+    Args:
+        log_line (str): Line of the log file
+
+    Returns:
+        List[str]: Columns of the line, starting with the timestamp. None if the line has not enough columns
+    """
+    log_line = log_line.lower().strip('\t \n')
+    log_line_split = log_line.split('\t')
+    if len(log_line)<=1 or len(log_line_split)<=2:
+        return None
+    # Some lines do not start correctly
+    if log_line_split[0].startswith('--/'):
+        log_line_split = log_line_split[1:]
+    return log_line_split
+
+def start_time_gamma(log_line:str) -> Tuple[datetime, timedelta]:
+    """Get the start time of a recording from the first line of gamma/.log files
+
+    Args:
+        log_line (str): First line of the log file
+
+    Returns:
+        datetime: Start time of the recording
+        timedelta: Correction for am/pm logs
+    """
+    log_line_split = split_log_line_gamma(log_line)
+    timestamp = parse_timestamp_gamma(log_line_split[0], datetime.fromtimestamp(0)) if log_line_split is not None else None
+    if timestamp is None:
+        raise ValueError(f"Start time not found in the first line of gamma log: {log_line}")
+    if timestamp.hour>12: # Most of the timestamps are on 24h, some have am/pm timestamps
+        timestamp_correction = timedelta(hours=0)
+    else:
+        timestamp_correction = timedelta(hours=12)
+    return timestamp+timestamp_correction, timestamp_correction
+
+def _seconds_from_start(start_time:datetime, timestamp:datetime) -> int:
+    """Seconds between the start of the recording and a timestamp, wrapping at midnight"""
+    return (timestamp.hour*3600 + timestamp.minute*60 + timestamp.second - (start_time.hour*3600 + start_time.minute*60 + start_time.second)) % 86400
+
+def _iter_log_gamma(log_file:Iterable[str], log_filename:str, start_time:datetime, timestamp_correction:timedelta, mapping:Mapper, report:ParseReport) -> Iterator[Tuple[int, int, Event]]:
+    """Parse lines of gamma/.log files. Yield (seconds from start, line number, output line)"""
+    for i, log_line in enumerate(log_file, start=1):
+        log_line = log_line.lower().strip('\t \n')
+        log_line_split = split_log_line_gamma(log_line)
+        if log_line_split is None:
+            continue
+
+        # Parse timestamp
+        timestamp = parse_timestamp_gamma(log_line_split[0], start_time)
+        if timestamp is None:
+            print(f"Parsing error gamma in line: {log_line}", file=sys.stderr)
+            continue
+
+        # Parse line
+        timestamp = timestamp + timestamp_correction
+        timestamp_str = timestamp.strftime("%H:%M:%S.00")
+        event_key = log_line_split[1].strip("\t ")
+        # Skip empty lines
+        if len(event_key)==0:
+            continue
 
-def process_gamma_log(recording:str, input_filename:str, output_filename:str, mapping:dict) -> Tuple[bool, set]:
+        if not ': gain' in event_key:
+            output_line = Event(timestamp_str, mapping.map(event_key))
+        else:
+            parsed_line = parse_gain_gamma(event_key)
+            if parsed_line is None:
+                print(f"Parsing error gamma in line: {event_key}", file=sys.stderr)
+                report.errors.append((log_filename, i, event_key))
+                continue
+            event_key, param1, param2 = parsed_line
+            output_line = Event(timestamp_str, event_key, Param1=param1, Param2=param2)
+
+        report.add_unmapped(output_line)
+        yield _seconds_from_start(start_time, timestamp), i, output_line
+
+def _iter_stages_gamma(stage_filename:str, start_time:datetime) -> Iterator[Tuple[int, int, Event]]:
+    """Parse lines of gamma/.stg files. Yield (seconds from start, line number, output line)"""
+    start_seconds = start_time.hour*3600 + start_time.minute*60 + start_time.second
+    for i, (offset, timestamp_str, event_key) in enumerate(zip(*read_stages_gamma(stage_filename, start_seconds)), start=1):
+        yield offset % 86400, i, Event(timestamp_str, event_key)
+
+def _iter_events_gamma(events_file, events_filename:str, start_time:datetime, timestamp_correction:timedelta, mapping:Mapper, report:ParseReport) -> Iterator[Tuple[int, int, Event]]:
+    """Parse lines of gamma/.sco files. Yield (seconds from start, line number, output line)"""
+    # Skip header line. Sometimes there is more than 1
+    first_line = events_file.readline()
+    has_header = False
+    skipped_lines = 1
+    while first_line.startswith("Epoch"):
+        first_line = events_file.readline()
+        has_header = True
+        skipped_lines += 1
+
+    # Return to first line if they don't have a header. Compressed files cannot seek, the line is chained back
+    if not has_header:
+        events_file = chain([first_line], events_file)
+        skipped_lines = 0
+
+    # Process lines
+    for i, event_line in enumerate(events_file, start=skipped_lines+1):
+        event_line = event_line.rstrip('\r\n')
+        # Skip spurious lines
+        if len(event_line.replace('\t','').strip("\t \n"))<=5:
+            continue
+
+        # Parse line
+        parsed_line = parse_event_gamma(event_line, start_time, timestamp_correction, mapping)
+        if parsed_line is None:
+            print(f"Parsing error gamma in line: {event_line}", file=sys.stderr)
+            report.errors.append((events_filename, i, event_line))
+            raise LineParseError(f"Parsing error in {events_filename} line {i}: {event_line}")
+
+        timestamp, output_line = parsed_line
+        report.add_unmapped(output_line)
+        yield _seconds_from_start(start_time, timestamp), i, output_line
+
+def iter_gamma_events(recording_path:str, mapping:Mapper, report:ParseReport=None, reorder_buffer:Union[int, None]=gamma_REORDER_BUFFER, suffixes:Iterable[str]=None) -> Iterator[Event]:
+    """Parse lines from gamma/(log,sco,stg) files lazily. The three files are read as streams and merged in time order.
+       Lines that cannot be parsed are skipped and logged in the report, errors in the events file raise a LineParseError.
+       Files of am/pm recordings (see start_time_gamma) are sorted as a whole, as their clock restarts at noon. In other
+       recordings, lines displaced beyond the reorder buffer raise an OutOfOrderError, use reorder_buffer=None to sort the whole files.
+
+    Args:
+        recording_path (str): Path of the recording without suffixes e.g wsc-visit1-100000-nsrr. Compressed files are used if the
+            uncompressed ones do not exist, see find_input
+        mapping (Mapper): Event keys mapping. See mappings.txt
+        report (ParseReport, optional): Report of errors and unmapped lines. Defaults to None.
+        reorder_buffer (int, optional): Lines kept to fix the order of each file, not used for am/pm recordings. See reorder_by_time
+        suffixes (Iterable[str], optional): Suffixes of the files of the recording. See find_input
+
+    Yields:
+        Event: Output line
+    """
+    if report is None:
+        report = ParseReport(Path(recording_path).name)
+
+    log_filename, stage_filename, events_filename = [find_input(recording_path, suffix, suffixes) or recording_path+suffix
+                                                     for suffix in ['.log.txt', '.stg.txt', '.sco.txt']]
+    with open_input(log_filename) as log_file, open_input(events_filename) as events_file:
+        # Start time and am/pm correction from the first line of the log file
+        first_line = log_file.readline()
+        start_time, timestamp_correction = start_time_gamma(first_line)
+        log_file = chain([first_line], log_file)
+        if timestamp_correction:
+            reorder_buffer = None
+
+        # Merge log, stages and events. The merge is stable, lines with the same time keep this order of the files
+        timer = report.timer
+        sources = [
+            timer.wrap(_iter_log_gamma(log_file, log_filename, start_time, timestamp_correction, mapping, report), 'log'),
+            timer.wrap(_iter_stages_gamma(stage_filename, start_time), 'stg'),
+            timer.wrap(_iter_events_gamma(events_file, events_filename, start_time, timestamp_correction, mapping, report), 'sco'),
+        ]
+        for (_, _, output_line) in timer.wrap(heapq.merge(*[reorder_by_time(lines, reorder_buffer) for lines in sources], key=lambda x:x[0]), 'merge'):
+            yield output_line
+
+def process_gamma_log(recording:str, input_filename:str, output_filename:str, mapping:Mapper, collapse_stages:bool=False, output_format:str='txt', report:ParseReport=None, fsync:bool=False, suffixes:Iterable[str]=None) -> Tuple[bool, Counter]:
     """Parse lines from gamma/(log,sco,stg) files. This function receives only the recording id and then apply the specific suffixes
 
     Args:
         recording (str): id of the recording
         input_filename (str): Input log file e.g wsc-visit1-100000-nsrr
         output_filename (str): Output '.uniform.txt' log file
-        mapping (dict): Dictionary to map event keys. See mappings.txt
+        mapping (Mapper): Event keys mapping. See mappings.txt
+        collapse_stages (bool, optional): Write only stage transitions with their duration. See collapse_stage_lines
+        output_format (str, optional): Columnar format written alongside the output file. See write_output
+        report (ParseReport, optional): Report of errors, unmapped lines and phase times. Defaults to a new report.
+        fsync (bool, optional): Flush the output files to disk before replacing them. See write_output
+        suffixes (Iterable[str], optional): Suffixes of the files of the recording. See find_input
 
     Returns:
         bool: True if parsing concluded with no errors
-        set: Set of values that were not mapped (misc: prefix)
+        Counter: Number of lines of each value that was not mapped (misc: prefix)
     """
-    no_error = True
-    unmapped = set()
+    if report is None:
+        report = ParseReport(recording)
 
     assert input_filename.endswith("-nsrr"), f"Error in gamma parser. Expected input filename to indicate recording id, not specific files. Got {input_filename}"
-    for suffix in ['.log.txt', '.sco.txt', '.stg.txt']:
-        if not Path(input_filename+suffix).exists():
+    filenames = {suffix:find_input(input_filename, suffix, suffixes) for suffix in ['.log.txt', '.sco.txt', '.stg.txt']}
+    for (suffix, filename) in filenames.items():
+        if filename is None:
             warnings.warn(f"File {suffix} not found for gamma recording {recording}")
-            return False, unmapped
-
-    # Output is stored in a list of tuples (timestamp, values) so it can be ordered before writing the output file
-    temp_output = []
-    start_time = datetime.fromtimestamp(0)
-
-    # Start by parsing the log file
-    log_filename = f"{input_filename}.log.txt"
-    with open(log_filename, "r") as log_file:
-        for i, log_line in enumerate(log_file):
-            log_line = log_line.lower().strip('\t \n')
-            log_line_split = log_line.split('\t')
-            if len(log_line)<=1 or len(log_line_split)<=2:
-                continue
+            report.errors.append((input_filename+suffix, None, "File not found"))
+            return False, report.unmapped
+    # The inputs were found, they are not checked again
+    suffixes = [filename[len(input_filename):] for filename in filenames.values()]
+
+    for reorder_buffer in [gamma_REORDER_BUFFER, None]:
+        n_errors, unmapped = len(report.errors), Counter(report.unmapped)
+        output_lines = iter_gamma_events(input_filename, mapping, report, reorder_buffer, suffixes)
+        if collapse_stages:
+            output_lines = report.timer.wrap(collapse_stage_lines(output_lines), 'collapse')
+        try:
+            with report.timer.phase('write'):
+                write_output(output_lines, output_filename, output_format, fsync)
+            break
+        except OutOfOrderError:
+            # Lines too far from their position in time, not expected outside am/pm recordings. Parse again sorting
+            # the whole files, the partial output was discarded by write_output
+            del report.errors[n_errors:]
+            report.unmapped.clear()
+            report.unmapped.update(unmapped)
 
-            # Some lines do not start correctly
-            if log_line_split[0].startswith('--/'):
-                log_line_split = log_line_split[1:]
-            
-            # Parse timestamp
-            timestamp = parse_timestamp_gamma(log_line_split[0], start_time)
-            if timestamp is None:
-                print(f"Parsing error gamma in line: {log_line}")
-                continue
+    return report.no_error, report.unmapped
 
-            # First line checks
-            if i == 0:
-                if timestamp.hour>12: # Most of the timestamps are on 24h, some have am/pm timestamps
-                    timestamp_correction = timedelta(hours=0)
-                else:
-                    timestamp_correction = timedelta(hours=12)
-                start_time = timestamp+timestamp_correction
-
-            # Create output line
-            output_line = copy(EMPTY_LINE)
-
-            # Parse line
-            timestamp = timestamp + timestamp_correction
-            output_line['Timestamp'] = timestamp.strftime("%H:%M:%S.00")
-            event_key = log_line_split[1].strip("\t ")
-            # Skip empty lines
-            if len(event_key)==0:
-                continue
+def hash_mapping(mapping:dict) -> str:
+    """Return a digest of the loaded mappings, so that recordings are reprocessed when mappings.txt changes
 
-            if not ': gain' in event_key:
-                output_line['EventKey'] = map_event(event_key, mapping)
-            else:
-                parsed_line = parse_gain_gamma(event_key)
-                if parsed_line is None:
-                    print(f"Parsing error gamma in line: {event_key}")
-                    no_error = False
+    Args:
+        mapping (dict): Destination value of each source value. See Mapper
+
+    Returns:
+        str: sha256 hex digest
+    """
+    import hashlib
+    return hashlib.sha256(json.dumps(mapping, sort_keys=True).encode('utf-8')).hexdigest()
+
+def file_signature(filename:str, previous:dict=None) -> dict:
+    """Return size, modification time and content hash of a file.
+    The hash of the previous signature is reused if size and modification time did not change.
+
+    Args:
+        filename (str): Path of the file
+        previous (dict, optional): Signature stored in the manifest. Defaults to None.
+
+    Returns:
+        dict: Signature with keys 'size', 'mtime_ns' and 'sha256'
+    """
+    stat = os.stat(filename)
+    signature = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if previous is not None and all(previous.get(k)==v for (k,v) in signature.items()):
+        signature['sha256'] = previous['sha256']
+        return signature
+
+    import hashlib
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(1<<20), b''):
+            sha.update(chunk)
+    signature['sha256'] = sha.hexdigest()
+    return signature
+
+def manifest_entry(folder:str, recording:str, mapping_hash:str, previous:dict=None, options:dict=None, suffixes:Iterable[str]=None) -> dict:
+    """Build the manifest entry of a recording from its input files, the mappings, the output options and the tool version
+
+    Args:
+        folder (str): Path to the folder containing the log files
+        recording (str): id of the recording
+        mapping_hash (str): Digest of the mappings. See hash_mapping
+        previous (dict, optional): Entry stored in the manifest. Defaults to None.
+        options (dict, optional): Options that change the output. See process_recording
+        suffixes (Iterable[str], optional): Suffixes of the files of the recording. See RecordingFiles. Defaults to checking the files on disk.
+
+    Returns:
+        dict: Manifest entry
+    """
+    previous_inputs = previous.get('inputs', {}) if previous is not None else {}
+    inputs = {}
+    for suffix in [suffix+extension for suffix in INPUT_SUFFIXES for extension in ('',)+COMPRESSION_EXTENSIONS]:
+        input_filename = f"{folder}/{recording}{suffix}"
+        if (suffix in suffixes) if suffixes is not None else Path(input_filename).exists():
+            inputs[suffix] = file_signature(input_filename, previous_inputs.get(suffix))
+    return {'version': __version__, 'mapping': mapping_hash, 'options': options or {}, 'inputs': inputs}
+
+def is_up_to_date(entry:dict, previous:dict) -> bool:
+    """Check if a recording needs to be processed again comparing the new and stored manifest entries
+
+    Args:
+        entry (dict): Current entry. See manifest_entry
+        previous (dict): Entry stored in the manifest, None if the recording was never processed
+
+    Returns:
+        bool: True if inputs, mappings, options and version did not change
+    """
+    if previous is None:
+        return False
+    return all(entry[k]==previous.get(k) for k in ['version', 'mapping', 'options']) and \
+        {k:v['sha256'] for (k,v) in entry['inputs'].items()} == {k:v['sha256'] for (k,v) in previous.get('inputs', {}).items()}
+
+def load_manifest(folder:str, filename:str=MANIFEST_FILENAME) -> dict:
+    """Load the build manifest of a folder. Return an empty manifest if missing or unreadable
+
+    Args:
+        folder (str): Path to the folder containing the log files
+        filename (str, optional): Name of the manifest. Defaults to MANIFEST_FILENAME, QUARANTINE_FILENAME for failed recordings.
+
+    Returns:
+        dict: Manifest entries by recording id
+    """
+    manifest_filename = f"{folder}/{filename}"
+    if not Path(manifest_filename).exists():
+        return {}
+    try:
+        with open(manifest_filename, 'r', encoding='utf-8') as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        warnings.warn(f"Manifest {manifest_filename} is not readable. All recordings will be processed")
+        return {}
+
+def save_manifest(folder:str, manifest:dict, filename:str=MANIFEST_FILENAME):
+    """Write the build manifest of a folder. The file is replaced only when completely written
+
+    Args:
+        folder (str): Path to the folder containing the log files
+        manifest (dict): Manifest entries by recording id
+        filename (str, optional): Name of the manifest. Defaults to MANIFEST_FILENAME, QUARANTINE_FILENAME for failed recordings.
+    """
+    with atomic_open(f"{folder}/{filename}", 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, sort_keys=True)
+
+def _init_worker(mapping:dict):
+    """Set the mappings once per worker process of the pool (see process_recording). Maps are sent by the main process,
+    so that workers do not read the mapping files
+
+    Args:
+        mapping (dict): Destination value of each source value. See Mapper
+    """
+    global _worker_mapping
+    _worker_mapping = Mapper(mapping)
+
+def process_recording(folder:str, recording:Union[str, RecordingFiles], mapping:Mapper=None, collapse_stages:bool=False, output_format:str='txt', output_compression:str=None, metrics:bool=False, keep_going:bool=False, fsync:bool=False, output_folder:str=None) -> Tuple[str, ParseReport, float, Union[dict, None]]:
+    """Detect the type of log of a recording and parse it with the twin or gamma parser
+
+    Args:
+        folder (str): Path to the folder containing the log files
+        recording (Union[str, RecordingFiles]): Files of the recording (see scan_recordings) or its id, the files are then checked on disk
+        mapping (Mapper, optional): Event keys mapping. Defaults to the mappings loaded by the worker process.
+        collapse_stages (bool, optional): Write only stage transitions with their duration. See collapse_stage_lines
+        output_format (str, optional): Columnar format written alongside the output file. See write_output
+        output_compression (str, optional): 'gz' or 'zst' to compress the '.uniform.txt' file. Defaults to None (not compressed).
+        metrics (bool, optional): Measure the time spent in each phase. See PhaseTimer. Defaults to False.
+        keep_going (bool, optional): Log exceptions raised while parsing in the report instead of raising them. Defaults to False.
+        fsync (bool, optional): Flush the output files to disk before replacing them. See write_output
+        output_folder (str, optional): Folder of the output files, created if missing. Defaults to folder (next to the log files).
+
+    Returns:
+        str: id of the recording
+        ParseReport: Errors and unmapped lines of the recording
+        float: Processing time in seconds
+        dict: Metrics of the recording (time and lines of each phase, parse errors, unmapped lines). None if metrics is False
+    """
+    if mapping is None:
+        mapping = _worker_mapping
+
+    # Log time start
+    t_start = perf_counter()
+
+    # Filenames
+    files = recording if isinstance(recording, RecordingFiles) else probe_recording(folder, recording)
+    recording = files.recording
+    recording_path = f"{folder}/{recording}"
+    output_filename = uniform_filename(recording_path if output_folder is None else f"{output_folder}/{recording}", output_compression)
+    if output_folder is not None:
+        Path(output_filename).parent.mkdir(parents=True, exist_ok=True)
+
+    # Detect type of log and parse file
+    report = ParseReport(recording, PhaseTimer(enabled=metrics))
+    log_format = files.log_format
+    try:
+        if log_format == 'gamma':
+            process_gamma_log(recording, recording_path, output_filename, mapping, collapse_stages, output_format, report, fsync, files.suffixes)
+        else:
+            allscore_filename = find_input(recording_path, '.allscore.txt', files.suffixes)
+            process_twin_log(recording, allscore_filename, output_filename, mapping, collapse_stages, output_format, report, fsync)
+    except Exception as error:
+        if not keep_going:
+            raise
+        # Lines that cannot be parsed are already in the errors
+        if not isinstance(error, LineParseError):
+            report.errors.append((recording_path, None, f"{type(error).__name__}: {error}"))
+    elapsed = perf_counter()-t_start
+
+    recording_metrics = None
+    if metrics:
+        recording_metrics = {
+            'format': log_format,
+            'time': elapsed,
+            'phases': dict(report.timer.times),
+            'lines': dict(report.timer.lines),
+            'errors': len(report.errors),
+            'unmapped_lines': sum(report.unmapped.values()),
+            'unmapped_values': len(report.unmapped),
+        }
+    return recording, report, elapsed, recording_metrics
+
+def iter_processed_recordings(folder:str, recordings:List[Union[str, RecordingFiles]], mapping:Mapper, jobs:int=1, metrics:bool=False, keep_going:bool=False, fsync:bool=False, output_folder:str=None, **options) -> Iterator[Tuple[str, ParseReport, float, Union[dict, None]]]:
+    """Process recordings sequentially or with a pool of processes. Results are yielded in order of completion.
+
+    Args:
+        folder (str): Path to the folder containing the log files
+        recordings (List[Union[str, RecordingFiles]]): Files of the recordings or their ids. See process_recording
+        mapping (Mapper): Event keys mapping. Workers receive a copy of the maps when they start
+        jobs (int, optional): Number of worker processes. Defaults to 1 (sequential).
+        metrics (bool, optional): Measure the time spent in each phase. See process_recording
+        keep_going (bool, optional): Log exceptions in the report of the recording. See process_recording
+        fsync (bool, optional): Flush the output files to disk before replacing them. See process_recording
+        output_folder (str, optional): Folder of the output files. See process_recording
+        **options: Output options forwarded to process_recording
+
+    Yields:
+        Tuple[str, ParseReport, float, dict]: Output of process_recording
+    """
+    if jobs == 1:
+        for recording in recordings:
+            yield process_recording(folder, recording, mapping, metrics=metrics, keep_going=keep_going, fsync=fsync, output_folder=output_folder, **options)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(mapping.mapping,)) as executor:
+        futures = [executor.submit(process_recording, folder, recording, None, metrics=metrics, keep_going=keep_going, fsync=fsync, output_folder=output_folder, **options) for recording in recordings]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            # Drop pending recordings if the caller stops early (e.g. parsing errors)
+            for future in futures:
+                future.cancel()
+
+def write_cohort_dataset(folder:str, recordings:List[str], output_format:str, cohort_filename:str, fsync:bool=False):
+    """Concatenate the columnar files of all recordings in a single dataset with an extra dictionary encoded Recording column
+
+    Args:
+        folder (str): Path to the folder containing the log files
+        recordings (List[str]): List of recordings
+        output_format (str): 'npz' or 'parquet'. See write_output
+        cohort_filename (str): Output file of the cohort dataset
+        fsync (bool, optional): Flush the file to disk before replacing it. See atomic_open
+    """
+    np, pa, pq = optional_module('numpy'), optional_module('pyarrow'), optional_module('pyarrow.parquet')
+    filenames = [columnar_filename(f"{folder}/{recording}.uniform.txt", output_format) for recording in recordings]
+    if output_format == 'parquet':
+        tables = []
+        for i, (recording, filename) in enumerate(zip(recordings, filenames)):
+            table = pq.read_table(filename)
+            recording_code = pa.array(np.full(table.num_rows, i, dtype=np.int32))
+            tables.append(table.append_column('Recording', pa.DictionaryArray.from_arrays(recording_code, pa.array(recordings, type=pa.string()))))
+        with atomic_open(cohort_filename, 'wb', fsync) as cohort_file:
+            pq.write_table(pa.concat_tables(tables).unify_dictionaries(), cohort_file)
+    elif output_format == 'npz':
+        event_keys = {}
+        columns = {k:[] for k in ['Timestamp', 'EventCode', 'RecordingCode']+OUTPUT_HEADER[2:]}
+        for i, filename in enumerate(filenames):
+            with np.load(filename) as data:
+                # Map event codes of the recording to the codes of the cohort
+                event_code_map = np.array([event_keys.setdefault(k, len(event_keys)) for k in data['EventKeys']], dtype=np.int32)
+                columns['EventCode'].append(event_code_map[data['EventCode']] if len(event_code_map)>0 else data['EventCode'])
+                columns['RecordingCode'].append(np.full(len(data['Timestamp']), i, dtype=np.int32))
+                for k in ['Timestamp']+OUTPUT_HEADER[2:]:
+                    columns[k].append(data[k])
+        with atomic_open(cohort_filename, 'wb', fsync) as cohort_file:
+            np.savez_compressed(cohort_file, EventKeys=np.array(list(event_keys), dtype=str), Recordings=np.array(recordings, dtype=str),
+                                **{k:np.concatenate(v) for (k,v) in columns.items()})
+    else:
+        raise ValueError(f"Unknown columnar output format {output_format}")
+
+def update_index(index_filename:str, folder:str, recordings:List[RecordingFiles], output_compression:str=None, removed:Iterable[str]=()) -> int:
+    """Add the events of the recordings to a SQLite index, to query events across recordings without reading their files.
+       Only recordings whose '.uniform.txt' file changed since the last update (size or modification time) are read again.
+       The index is updated in a single transaction
+
+    Args:
+        index_filename (str): SQLite index, created if missing. See INDEX_SCHEMA
+        folder (str): Path to the folder containing the log files
+        recordings (List[RecordingFiles]): Recordings to index. See scan_recordings
+        output_compression (str, optional): Compression of the '.uniform.txt' files. See uniform_filename
+        removed (Iterable[str], optional): ids of recordings to remove from the index e.g. failed recordings. Defaults to ().
+
+    Returns:
+        int: Number of recordings added or updated
+    """
+    import sqlite3
+    connection = sqlite3.connect(index_filename)
+    try:
+        connection.executescript(INDEX_SCHEMA)
+        with connection:
+            indexed = {recording:(recording_id, size, mtime_ns) for (recording, recording_id, size, mtime_ns) in connection.execute("SELECT recording, id, size, mtime_ns FROM recordings")}
+            event_keys = dict(connection.execute("SELECT event_key, id FROM event_keys"))
+
+            def remove(recording):
+                connection.execute("DELETE FROM events WHERE recording_id = ?", (indexed[recording][0],))
+                connection.execute("DELETE FROM recordings WHERE id = ?", (indexed.pop(recording)[0],))
+
+            for recording in removed:
+                if recording in indexed:
+                    remove(recording)
+
+            n_updated = 0
+            for files in recordings:
+                filename = uniform_filename(f"{folder}/{files.recording}", output_compression)
+                if not Path(filename).exists():
+                    if files.recording in indexed:
+                        remove(files.recording)
                     continue
-                output_line.update(parsed_line)
-
-            
-            # Log non mapped / misc lines
-            if output_line['EventKey'].startswith('misc'):
-                unmapped.add(f"{recording} - {output_line['Timestamp']} - {output_line['EventKey']}")
-
-            # Append results
-            temp_output.append((timestamp, output_line))
-
-    # Parse sleep stages
-    stage_filename = f"{input_filename}.stg.txt"
-    stage_map = {'7':'undefined','0':'w','1':'n1','2':'n2','3':'n3','4':'n3','5':'rem','6':'undefined'}
-    with open(stage_filename, 'r') as stage_file:
-        reader = DictReader(stage_file, fieldnames=['Epoch', 'User-Defined Stage', 'CAST-Defined Stage'], delimiter='\t')
-        for stage_line in reader:
-            # Header line is in most files, but not all of them. Check the first line and skip if it's the header
-            if stage_line['Epoch']=='Epoch':
-                continue
-            
-            # Create output line
-            output_line = copy(EMPTY_LINE)
-
-            # Parse data NOTE timedelta it's a slightly inefficient function for many repeated values.
-            # The stage loops takes more time than the other files
-            timestamp = start_time+timedelta(seconds=(int(stage_line['Epoch'])-1)*30)
-            output_line['Timestamp'] = timestamp.strftime("%H:%M:%S.00")
-            output_line['EventKey'] = f"stage:{stage_map.get(stage_line[gamma_STAGE_COLUMN], 'undefined')}"
-
-            # Append results
-            temp_output.append((timestamp, output_line))
-
-    # Parse events
-    events_filename = f"{input_filename}.sco.txt"
-    with open(events_filename, 'r') as events_file:
-        # Skip header line. Sometimes there is more than 1
-        first_line = events_file.readline()
-        has_header = False
-        while first_line.startswith("Epoch"):
-            first_line = events_file.readline()
-            has_header = True
-        
-        # Return to first line if they don't have a header
-        if not has_header:
-            events_file.seek(0)
-        
-        # Process lines
-        for event_line in events_file.read().splitlines():
-            # Skip spurious lines
-            if len(event_line.replace('\t','').strip("\t \n"))<=5:
-                continue
+                stat = os.stat(filename)
+                if indexed.get(files.recording, (None,))[1:] == (stat.st_size, stat.st_mtime_ns):
+                    continue
+                if files.recording in indexed:
+                    remove(files.recording)
+
+                recording_id = connection.execute("INSERT INTO recordings (recording, visit, subject, size, mtime_ns) VALUES (?, ?, ?, ?, ?)",
+                                                  (files.recording, files.visit, files.subject, stat.st_size, stat.st_mtime_ns)).lastrowid
+                rows = []
+                with open_input(filename, encoding='utf-8') as input_file:
+                    reader = csv.reader(input_file)
+                    next(reader, None)
+                    for line, row in enumerate(reader, start=1):
+                        if row[1] not in event_keys:
+                            event_keys[row[1]] = connection.execute("INSERT INTO event_keys (event_key) VALUES (?)", (row[1],)).lastrowid
+                        # NaN values are stored as NULL
+                        rows.append((recording_id, line, event_keys[row[1]], row[0], *[_to_float(value) for value in row[2:]]))
+                connection.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                n_updated += 1
+    finally:
+        connection.close()
+    return n_updated
+
+def query_index(index_filename:str, event_keys:Iterable[str]=None, visits:Iterable[int]=None, subjects:Iterable[str]=None,
+                conditions:Iterable[Tuple[str, str, float]]=()) -> Iterator[Tuple[str, int, Event]]:
+    """Query events across recordings from the index built by update_index. Results are sorted by recording and line
+
+    Args:
+        index_filename (str): SQLite index. See update_index
+        event_keys (Iterable[str], optional): Keep only these event keys e.g. ['apnea:obstructive']. Defaults to all event keys.
+        visits (Iterable[int], optional): Keep only these visits. Defaults to all visits.
+        subjects (Iterable[str], optional): Keep only these subject ids. Defaults to all subjects.
+        conditions (Iterable[Tuple[str, str, float]], optional): Conditions on the values e.g. [('Param1', '<', 85)]. See INDEX_OPERATORS
+
+    Yields:
+        Tuple[str, int, Event]: id of the recording, line in its '.uniform.txt' file (header excluded) and event.
+            Missing or non numeric values are None
+    """
+    query = "SELECT r.recording, e.line, e.Timestamp, k.event_key, e.Duration, e.Param1, e.Param2, e.Param3 FROM events e " \
+            "JOIN event_keys k ON k.id = e.event_key_id JOIN recordings r ON r.id = e.recording_id"
+    where = []
+    parameters = []
+    for (column, values) in [('k.event_key', event_keys), ('r.visit', visits), ('r.subject', subjects)]:
+        if values is not None:
+            values = [str(value) for value in values]
+            where.append(f"{column} IN ({', '.join('?'*len(values))})")
+            parameters += values
+    for (column, operator, value) in conditions:
+        if column not in OUTPUT_HEADER[2:] or operator not in INDEX_OPERATORS:
+            raise ValueError(f"Unsupported condition {column} {operator} {value}")
+        where.append(f"e.{column} {operator} ?")
+        parameters.append(value)
+    if len(where) > 0:
+        query += " WHERE " + " AND ".join(where)
+    query += " ORDER BY r.recording, e.line"
+
+    import sqlite3
+    connection = sqlite3.connect(f"file:{index_filename}?mode=ro", uri=True)
+    try:
+        for (recording, line, *values) in connection.execute(query, parameters):
+            yield recording, line, Event(*values)
+    finally:
+        connection.close()
+
+def parse_arguments(argv:List[str]=None) -> 'argparse.Namespace':
+    """Parse command line arguments of wsc_clean
 
-            # Parse line
-            output_line = parse_event_gamma(event_line, start_time, timestamp_correction, mapping)
-            if output_line is None:
-                print(f"Parsing error gamma in line: {event_line}")
-                no_error = False
-                raise ValueError
-            
-            # Append results
-            timestamp = output_line['Timestamp']
-            output_line['Timestamp'] = timestamp.strftime("%H:%M:%S.00")
-            temp_output.append((timestamp, output_line))
-
-            # Log non mapped / misc lines
-            if output_line['EventKey'].startswith('misc'):
-                unmapped.add(f"{recording} - {output_line['Timestamp']} - {output_line['EventKey']}")
-
-    # Sort and write output
-    temp_output.sort(key=lambda x:datetime_sorter(start_time, x[0]))
-    with open(output_filename, 'w', encoding='utf-8') as output_file:
-        # Write output header
-        writer = DictWriter(output_file, fieldnames=OUTPUT_HEADER, lineterminator='\n')
-        writer.writeheader()
-        # Write lines
-        for _,output_line in temp_output:
-            writer.writerow(output_line)        
-
-    return no_error, unmapped
+    Args:
+        argv (List[str], optional): Command line arguments. Defaults to sys.argv.
 
-def main():
-    # Get data folder
-    if len(sys.argv)<2:
-        print("Error! Usage wsc_clean.py <wsc_polysomnography_folder>")
-        sys.exit(1)
-    folder = sys.argv[1]
+    Returns:
+        argparse.Namespace: Parsed arguments
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="wsc_clean", description="Clean and uniform annotation files from Wisconsin Sleep Cohort (WSC)")
+    parser.add_argument("folder", nargs='?', help="WSC polysomnography folder")
+    parser.add_argument("--in", dest="input_folder", metavar="DIR", help="WSC polysomnography folder, alternative to the positional folder")
+    parser.add_argument("--out", dest="output_folder", metavar="DIR", help="Write the output files, manifest and quarantine in DIR instead of the polysomnography folder")
+    parser.add_argument("--recording", nargs='+', metavar="ID", help="Process only these recordings (e.g. wsc-visit2-12345-nsrr) without scanning the folder nor using its manifest. "
+                        "Errors and unmapped lines are printed, the exit status is 1 if any recording failed")
+    parser.add_argument("--stdin", action="store_true", help="Read a twin .allscore.txt file from stdin and write the uniform CSV to stdout. Errors and unmapped lines are printed to stderr")
+    parser.add_argument("--mappings", metavar="FILE", nargs='+', help="Extra mapping files in the format of mappings.txt, applied over the maps of the package (later files win)")
+    parser.add_argument("-r", "--recursive", action="store_true", help="Search recordings also in the subfolders of folder")
+    parser.add_argument("--visit", type=int, nargs='+', metavar="N", help="Process only the recordings of these visits e.g. --visit 1 2")
+    parser.add_argument("--subjects", metavar="FILE", help="Process only the subjects listed in FILE (ids separated by spaces, commas or new lines)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of recordings processed in parallel. 0 uses all available cores. Defaults to 1")
+    parser.add_argument("-f", "--force", action="store_true", help="Process all recordings, even if inputs and mappings did not change since the last run")
+    parser.add_argument("--collapse-stages", action="store_true", help="Write sleep stages only when they change, with the duration of the stage")
+    parser.add_argument("--output-format", choices=['txt', 'npz', 'parquet'], default='txt', help="Write also a typed columnar file (NumPy .npz or Parquet) for each recording. Defaults to txt only")
+    parser.add_argument("--output-compression", choices=['gz', 'zst'], help="Compress the .uniform.txt files (.uniform.txt.gz or .uniform.txt.zst). zst requires zstandard")
+    parser.add_argument("--cohort-output", metavar="FILE", help="Write a single columnar dataset with all recordings. Requires a columnar --output-format")
+    parser.add_argument("--index", metavar="FILE", help="Create or update a SQLite index of the events of all recordings, to query events across recordings (see query_index)")
+    parser.add_argument("--metrics", metavar="FILE", help="Write a JSON file with the time spent in each phase, line counts, parse errors and unmapped lines of each recording")
+    parser.add_argument("--fsync", action="store_true", help="Flush each output file to disk before moving it in place. Slower, but files survive power losses")
+    parser.add_argument("-k", "--keep-going", action="store_true", help="Do not stop at the first recording with parsing errors. Failed recordings are listed in an error report and processed again by --retry-failed")
+    parser.add_argument("--retry-failed", action="store_true", help="Process only the recordings that failed in previous runs. Implies --keep-going")
+    parser.add_argument("--profile", metavar="FILE", help="Run with cProfile and save the stats to FILE (see pstats). With --jobs only the main process is profiled")
+    args = parser.parse_args(argv)
+    if args.folder is not None and args.input_folder is not None:
+        parser.error("use either folder or --in")
+    args.folder = args.folder if args.folder is not None else args.input_folder
+    if args.stdin:
+        incompatible = [name for (name, value) in [('folder', args.folder), ('--out', args.output_folder), ('--output-format', args.output_format != 'txt'),
+                        ('--output-compression', args.output_compression), ('--cohort-output', args.cohort_output), ('--index', args.index)] if value]
+        if len(incompatible) > 0:
+            parser.error(f"--stdin cannot be used with {', '.join(incompatible)}")
+        if args.recording is not None and len(args.recording) > 1:
+            parser.error("--stdin accepts a single --recording id")
+    elif args.folder is None:
+        parser.error("the folder (or --in DIR) is required")
+    if args.recording is not None and not args.stdin:
+        incompatible = [name for (name, value) in [('--recursive', args.recursive), ('--visit', args.visit), ('--subjects', args.subjects),
+                        ('--retry-failed', args.retry_failed), ('--cohort-output', args.cohort_output), ('--index', args.index)] if value]
+        if len(incompatible) > 0:
+            parser.error(f"--recording cannot be used with {', '.join(incompatible)}")
+    if args.jobs < 0:
+        parser.error("--jobs must be a positive number")
+    for mapping_file in args.mappings or []:
+        if not Path(mapping_file).exists():
+            parser.error(f"--mappings file {mapping_file} not found")
+    if args.subjects is not None and not Path(args.subjects).exists():
+        parser.error(f"--subjects file {args.subjects} not found")
+    if args.output_format != 'txt' and optional_module('numpy') is None:
+        parser.error(f"--output-format {args.output_format} requires NumPy")
+    if args.output_compression == 'zst' and optional_module('zstandard') is None:
+        parser.error("--output-compression zst requires zstandard")
+    if args.output_format == 'parquet' and optional_module('pyarrow.parquet') is None:
+        parser.error("--output-format parquet requires pyarrow")
+    if args.cohort_output is not None and args.output_format == 'txt':
+        parser.error("--cohort-output requires --output-format npz or parquet")
+    if args.jobs == 0:
+        args.jobs = os.cpu_count() or 1
+    if args.retry_failed:
+        args.keep_going = True
+    return args
+
+def save_metrics(metrics_filename:str, metrics:dict):
+    """Write the metrics of a run to a JSON file
+
+    Args:
+        metrics_filename (str): Output JSON file
+        metrics (dict): Metrics of the run and of each recording. See process_recording
+    """
+    with atomic_open(metrics_filename, 'w', encoding='utf-8') as metrics_file:
+        json.dump(metrics, metrics_file, indent=1)
+
+def write_failed_report(failed_filename:str, quarantine:dict):
+    """Write the errors of the failed recordings as '<recording> - <file>:<line number> - <line or error>'
+
+    Args:
+        failed_filename (str): Output text file
+        quarantine (dict): Errors of each failed recording. See process_recording
+    """
+    with open(failed_filename, 'w', encoding='utf-8') as failed_file:
+        for recording in sorted(quarantine):
+            for (filename, line_number, line) in quarantine[recording]['errors']:
+                location = f"{filename}:{line_number}" if line_number is not None else filename
+                failed_file.write(f"{recording} - {location} - {line}\n")
+
+def clean_folder(args:'argparse.Namespace'):
+    """Clean all recordings of a folder. See parse_arguments for the options
+
+    Args:
+        args (argparse.Namespace): Parsed arguments
+    """
+    # Get data folder. Output files, manifest and quarantine are written next to the log files or in the output folder
+    folder = args.folder
     if not Path(folder).exists():
         print(f"Error! Folder '{folder}' not available or not found")
         sys.exit(1)
+    output_folder = args.output_folder if args.output_folder is not None else folder
+    Path(output_folder).mkdir(parents=True, exist_ok=True)
 
     # Load annotations mappings
     print("Loading mappings")
-    mapping = load_mappings()
+    mapping = load_mappings(args.mappings)
 
     # Get all recordings
     print("Identifying recordings")
-    recordings = find_recordings(folder)
-    n_recordings = len(recordings)
-    if n_recordings == 0:
+    subjects = load_subjects(args.subjects) if args.subjects is not None else None
+    recording_files = {files.recording:files for files in scan_recordings(folder, args.recursive, args.visit, subjects)}
+    recordings = list(recording_files)
+    if len(recordings) == 0:
         print(f"Error! No recordings found in folder {folder}. Exiting")
         sys.exit(1)
-    print(f"Starting the cleaning of {n_recordings} recordings")
 
-    # Keep track of non mapped lines
-    non_mapped_lines = set()
+    # Keep track of non mapped lines. Number of lines of each non mapped value by recording
+    non_mapped_lines = {}
+
+    # Options that change the output of a recording
+    options = {'collapse_stages': args.collapse_stages, 'output_format': args.output_format, 'output_compression': args.output_compression}
+
+    # Recordings that failed in previous runs
+    quarantine = load_manifest(output_folder, QUARANTINE_FILENAME)
+    failed_filename = 'WSC_failed_recordings.txt'
+    n_failed = 0
+
+    # Skip recordings whose inputs, mappings, options and version did not change since the last run
+    manifest = load_manifest(output_folder)
+    mapping_hash = hash_mapping(mapping.mapping)
+    all_recordings = recordings
+    entries = {}
+    for recording in recordings:
+        previous = manifest.get(recording)
+        if args.retry_failed and recording not in quarantine:
+            if previous is not None:
+                non_mapped_lines[recording] = previous.get('unmapped', {})
+            continue
+        entries[recording] = manifest_entry(folder, recording, mapping_hash, previous, options, recording_files[recording].suffixes)
+        if args.output_folder is None:
+            has_output = recording_files[recording].has_output(args.output_format, args.output_compression)
+        else:
+            output_filename = uniform_filename(f"{output_folder}/{recording}", args.output_compression)
+            has_output = Path(output_filename).exists() and (args.output_format == 'txt' or Path(columnar_filename(output_filename, args.output_format)).exists())
+        if not args.force and is_up_to_date(entries[recording], previous) and has_output:
+            non_mapped_lines[recording] = previous.get('unmapped', {})
+            # Refresh modification times of files that were touched but not changed
+            manifest[recording] = dict(entries.pop(recording), unmapped=non_mapped_lines[recording])
+    if args.retry_failed:
+        print(f"Retrying {len(entries)} recordings that failed in previous runs")
+    elif len(entries) < len(recordings):
+        print(f"Skipping {len(recordings)-len(entries)} recordings not changed since the last run. Use --force to process them again")
+    recordings = [recording for recording in recordings if recording in entries]
 
-    # Process recordings
-    eta = None
-    total_time = 0
-    for i, recording in enumerate(recordings, start=1):
-        eta_str = f"ETA : {eta}" if eta is not None else ""
-        print(f"Processing {recording} : {i}|{n_recordings}. {eta_str}")
+    n_recordings = len(recordings)
+    jobs = max(min(args.jobs, n_recordings), 1)
+    print(f"Starting the cleaning of {n_recordings} recordings" + (f" with {jobs} processes" if jobs>1 else ""))
+
+    # Metrics of the run, filled with the metrics of each recording
+    metrics = {'version': __version__, 'folder': folder, 'jobs': jobs, 'options': options, 'skipped': len(all_recordings)-n_recordings, 'recordings': {}}
+
+    # Process recordings. Recordings may complete out of order in parallel, ETA is based on the elapsed time
+    t_start = perf_counter()
+    results = iter_processed_recordings(folder, [recording_files[recording] for recording in recordings], mapping, jobs, metrics=args.metrics is not None, keep_going=args.keep_going, fsync=args.fsync, output_folder=args.output_folder, **options)
+    try:
+        for i, (recording, report, _, recording_metrics) in enumerate(results, start=1):
+            if recording_metrics is not None:
+                metrics['recordings'][recording] = recording_metrics
+            if not report.no_error:
+                # Quarantine the recording, it will be processed again in the next run or by --retry-failed
+                quarantine[recording] = {'errors': report.errors}
+                manifest.pop(recording, None)
+                n_failed += 1
+                if not args.keep_going:
+                    print(f"Error in parsing recording {recording}. Exiting.")
+                    results.close()
+                    sys.exit(1)
+                print(f"Error in parsing recording {recording}. See {failed_filename}")
+            else:
+                quarantine.pop(recording, None)
+                non_mapped_lines[recording] = dict(report.unmapped)
+                # Store the recording in the manifest
+                manifest[recording] = dict(entries[recording], unmapped=non_mapped_lines[recording])
+            if i % MANIFEST_SAVE_INTERVAL == 0:
+                save_manifest(output_folder, manifest)
+
+            # Update ETA
+            elapsed = perf_counter()-t_start
+            eta = timedelta(seconds=(n_recordings-i)*(elapsed/i))
+            print(f"Processed {recording} : {i}|{n_recordings}. ETA : {eta}")
+    finally:
+        # Keep completed recordings also if the run is interrupted
+        save_manifest(output_folder, manifest)
+        if len(quarantine) > 0 or Path(f"{output_folder}/{QUARANTINE_FILENAME}").exists():
+            save_manifest(output_folder, quarantine, QUARANTINE_FILENAME)
+            write_failed_report(f'./{failed_filename}', quarantine)
+        if args.metrics is not None:
+            metrics['total_time'] = perf_counter()-t_start
+            save_metrics(args.metrics, metrics)
+
+    total_time = perf_counter()-t_start
+    print(f"Parsing of {n_recordings} recordings completed in {timedelta(seconds=total_time)}.")
 
-        # Log time start
-        t_start = perf_counter()
+    # Consolidate columnar files of the whole cohort
+    if args.cohort_output is not None:
+        print(f"Writing cohort dataset {args.cohort_output}")
+        write_cohort_dataset(output_folder, [recording for recording in all_recordings if recording not in quarantine], args.output_format, args.cohort_output, args.fsync)
+    
+    # Index events of the cohort. Only recordings whose output changed are read again
+    if args.index is not None:
+        print(f"Updating event index {args.index}")
+        n_indexed = update_index(args.index, output_folder, [recording_files[recording] for recording in all_recordings if recording not in quarantine],
+                                 args.output_compression, removed=[recording for recording in all_recordings if recording in quarantine])
+        print(f"Indexed {n_indexed} new or changed recordings")
+
+    # Store unmapped lines as '<recording> - <value> - <number of lines>'. Sort on value and recording so that the report does not depend on the order of completion
+    non_mapped_filename = 'WSC_non_mapped_lines.txt'
+    non_mapped_counts = sorted((event_key, recording, count) for (recording, unmapped) in non_mapped_lines.items() for (event_key, count) in unmapped.items())
+    n_values = len({event_key for (event_key, _, _) in non_mapped_counts})
+    print(f"Non mapped lines that may need further checks: {sum(count for (_, _, count) in non_mapped_counts)} ({n_values} values). See {non_mapped_filename}")
+    with open(f'./{non_mapped_filename}', 'w', encoding='utf-8') as nfile:
+        for (event_key, recording, count) in non_mapped_counts:
+            nfile.write(f"{recording} - {event_key} - {count}\n")
 
-        # Filenames
-        recording_path = f"{folder}/{recording}"
-        allscore_filename = f"{recording_path}.allscore.txt"
-        output_filename = f"{folder}/{recording}.uniform.txt"
+    if n_failed > 0:
+        print(f"Error in parsing {n_failed} recordings. See {failed_filename}, use --retry-failed to process them again")
+        sys.exit(1)
 
-        # Detect type of log
-        has_allscore = Path(allscore_filename).exists()
+def clean_recordings(args:'argparse.Namespace'):
+    """Clean only the recordings given with --recording, without scanning the folder. Meant for job schedulers with a task
+       for each recording: the manifest, quarantine and reports of the folder are not read nor written (tasks would overwrite
+       each other), errors and unmapped lines are printed as in the reports. Exit with status 1 if any recording failed
 
-        # Parse file
-        if not has_allscore:
-            no_error = True
-            no_error, unmapped  = process_gamma_log(recording, recording_path, output_filename, mapping)
-        else:
-            no_error = True
-            no_error, unmapped  = process_twin_log(recording, allscore_filename, output_filename, mapping)
-        if no_error == False:
-            print(f"Error in parsing recording {recording}. Exiting.")
-            sys.exit(1)
+    Args:
+        args (argparse.Namespace): Parsed arguments. See parse_arguments
+    """
+    folder = args.folder
+    mapping = load_mappings(args.mappings)
+    options = {'collapse_stages': args.collapse_stages, 'output_format': args.output_format, 'output_compression': args.output_compression}
+    metrics = {'version': __version__, 'folder': folder, 'options': options, 'recordings': {}}
+
+    n_failed = 0
+    for recording in args.recording:
+        files = probe_recording(folder, recording)
+        if not any(suffix.startswith(('.allscore.txt', '.log.txt')) for suffix in files.suffixes):
+            print(f"Error! Recording {recording} not found in folder {folder}")
+            n_failed += 1
+            continue
+        _, report, elapsed, recording_metrics = process_recording(folder, files, mapping, metrics=args.metrics is not None, keep_going=True,
+                                                                  fsync=args.fsync, output_folder=args.output_folder, **options)
+        if recording_metrics is not None:
+            metrics['recordings'][recording] = recording_metrics
+        for (event_key, count) in sorted(report.unmapped.items()):
+            print(f"{recording} - {event_key} - {count}")
+        if not report.no_error:
+            for (filename, line_number, line) in report.errors:
+                print(f"{recording} - {f'{filename}:{line_number}' if line_number is not None else filename} - {line}")
+            print(f"Error in parsing recording {recording}")
+            n_failed += 1
         else:
-            non_mapped_lines.update(unmapped)
+            print(f"Processed {recording} in {timedelta(seconds=elapsed)}")
+
+    if args.metrics is not None:
+        save_metrics(args.metrics, metrics)
+    if n_failed > 0:
+        sys.exit(1)
 
-        # Log time end and update ETA
-        t_end = perf_counter()
-        total_time += (t_end-t_start)
-        eta = timedelta(seconds=(n_recordings-i)*(total_time/(i+1)))
+def clean_stream(input_file:Iterable[str], output_file:io.TextIOBase, mapping:Mapper, recording:str='stdin', collapse_stages:bool=False) -> ParseReport:
+    """Clean the lines of a twin/allscore file read from input_file and write the uniform CSV to output_file, e.g. from stdin to stdout
 
-    print(f"Parsing of {n_recordings} recordings completed in {timedelta(seconds=total_time)}.")
-    
-    # Store unmapped lines
-    non_mapped_filename = 'WSC_non_mapped_lines.txt'
-    non_mapped_lines = sorted(list(non_mapped_lines), key=lambda x:x.split(' - ')[-1])
-    print(f"Non mapped lines that may need further checks: {len(non_mapped_lines)}. See {non_mapped_filename}")
-    with open(f'./{non_mapped_filename}', 'w', encoding='utf-8') as nfile:
-        for line in non_mapped_lines:
-            nfile.write(line+'\n')
+    Args:
+        input_file (Iterable[str]): Lines of a twin .allscore.txt file
+        output_file (io.TextIOBase): Output text file
+        mapping (Mapper): Event keys mapping. See mappings.txt
+        recording (str, optional): id of the recording, used in the report. Defaults to 'stdin'.
+        collapse_stages (bool, optional): Write only stage transitions with their duration. See collapse_stage_lines
+
+    Returns:
+        ParseReport: Errors and unmapped lines of the recording
+    """
+    report = ParseReport(recording)
+    output_lines = _iter_twin_lines(input_file, '<stdin>', mapping, report)
+    if collapse_stages:
+        output_lines = collapse_stage_lines(output_lines)
+    _write_csv(output_lines, output_file)
+    return report
+
+def clean_stdin(args:'argparse.Namespace'):
+    """Clean a twin/allscore file read from stdin and write the uniform CSV to stdout. See clean_stream.
+       Errors and unmapped lines are printed to stderr, exit with status 1 in case of errors
+
+    Args:
+        args (argparse.Namespace): Parsed arguments. See parse_arguments
+    """
+    recording = args.recording[0] if args.recording is not None else 'stdin'
+    mapping = load_mappings(args.mappings)
+    # Same encoding of the files, independent of the locale
+    sys.stdin.reconfigure(encoding='utf-8', errors='ignore')
+    sys.stdout.reconfigure(encoding='utf-8')
+    try:
+        report = clean_stream(sys.stdin, sys.stdout, mapping, recording, args.collapse_stages)
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # The reader of stdout exited early (e.g. head). Do not flush the rest of the output at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+
+    for (event_key, count) in sorted(report.unmapped.items()):
+        print(f"{recording} - {event_key} - {count}", file=sys.stderr)
+    for (filename, line_number, line) in report.errors:
+        print(f"{recording} - {filename}:{line_number} - {line}", file=sys.stderr)
+    if not report.no_error:
+        sys.exit(1)
+
+def main():
+    args = parse_arguments()
+    if args.stdin:
+        run = clean_stdin
+    elif args.recording is not None:
+        run = clean_recordings
+    else:
+        run = clean_folder
+    if args.profile is None:
+        run(args)
+        return
+
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(run, args)
+    finally:
+        profiler.dump_stats(args.profile)
+        print(f"Profile stats saved in {args.profile}", file=sys.stderr)
         
 if __name__ == "__main__":
     main()
\ No newline at end of file